@@ -31,8 +31,8 @@ setup(name='hw_rsp_hat_v3',
       author="Hiwonder",
       author_email="support@hiwonder.com",
 
-      python_requires=">=3.6",
-      install_requires=['pigpio', 'RPi.GPIO', 'pyserial'],
+      python_requires=">=3.7",
+      install_requires=['RPi.GPIO', 'pyserial'],
 
       include_package_data=True,
       zip_safe=False,
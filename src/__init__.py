@@ -20,11 +20,22 @@
 # notes           :
 # ==============================================================================
 
-from . import action_set
-from . import buzzer
-from . import misc
-from . import pid
-from . import pwm_servo
-from . import serial_servo
+import importlib
 
-__all__ = ['serial_servo', 'pwm_servo', 'misc', 'buzzer', 'pid', 'action_set']
+__all__ = ['serial_servo', 'serial_servo_aio', 'pwm_servo', 'misc', 'buzzer', 'pid', 'action_set', 'telemetry',
+           'bus_arbiter', 'trajectory', 'recorder', 'control_loop', 'pid_sim', 'metrics', 'Board']
+
+
+def __getattr__(name):
+    # 子模块在首次访问时才导入, 硬件在首次使用或 open() 时才打开
+    # open 不放入 __all__, 以免 from hw_rsp_hat_v3 import * 覆盖内置的 open, 通过 hw_rsp_hat_v3.open() 访问
+    if name in ('Board', 'open'):
+        from . import board
+        return getattr(board, name)
+    if name in __all__:
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__) | {'open'})
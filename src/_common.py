@@ -20,9 +20,22 @@
 # notes           :
 # ==============================================================================
 
-import pigpio
-import RPi.GPIO as GPIO
+import threading
 
-_pi = pigpio.pi()
-GPIO.setwarnings(False)
-GPIO.setmode(GPIO.BOARD)
+_lock = threading.Lock()
+GPIO = None
+
+
+def gpio():
+    """
+    RPi.GPIO 模块, 首次调用时导入并设置为 BOARD 编号
+    """
+    global GPIO
+    if GPIO is None:
+        with _lock:
+            if GPIO is None:
+                import RPi.GPIO as gpio_
+                gpio_.setwarnings(False)
+                gpio_.setmode(gpio_.BOARD)
+                GPIO = gpio_
+    return GPIO
@@ -0,0 +1,254 @@
+# This file is part of rsp_robot_hat_v3.
+# Copyright (C) 2021 Hiwonder Ltd. <support@hiwonder.com>
+#
+# rsp_robot_hat_v3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rsp_robot_hat_v3 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# title           :_pwm_output.py
+# author          :Hiwonder, LuYongping(Lucas)
+# date            :20261018
+# notes           :speaks the pigpiod socket protocol directly
+# ==============================================================================
+
+import os
+import time
+import socket
+import struct
+import threading
+from . import metrics
+
+PI_CMD_SERVO = 8
+PI_CMD_GPW = 84
+PI_CMD_HP = 86
+
+PI_MIN_SERVO_PULSEWIDTH = 500  # 软件 PWM 舵机脉宽的有效范围, 0 为关闭输出
+PI_MAX_SERVO_PULSEWIDTH = 2500
+
+HARDWARE_PWM_PINS = {12: 0, 13: 1, 18: 0, 19: 1}  # 可输出硬件 PWM 的 gpio: 通道
+HARDWARE_PWM_RANGE = 1000000  # 硬件 PWM 占空比满量程
+
+DEFAULT_HOST = 'localhost'
+DEFAULT_PORT = 8888
+
+_cmd_struct = struct.Struct('<IIII')  # cmd, p1, p2, p3(扩展数据长度)
+_res_struct = struct.Struct('<IIIi')  # cmd, p1, p2, 结果
+_hp_struct = struct.Struct('<IIIII')  # HP 指令带 4 字节的占空比
+
+bus_metrics = metrics.BusMetrics('pwm', servo_label='gpio')  # 所有 PigpioOutput 共用, 收发字节由各自的 _lock 保护
+
+
+class PigpioError(ValueError):
+    """
+    守护进程拒绝了一批输出中的部分通道, pins 为被拒绝的 gpio, 其余通道已正常输出
+    """
+
+    def __init__(self, message, pins):
+        super().__init__(message)
+        self.pins = pins
+
+
+def duty_cycle(width, frequency):
+    """
+    脉宽换算为硬件 PWM 占空比
+    :param width: 脉宽(微秒)
+    :param frequency: 频率(Hz)
+    :return: 0~HARDWARE_PWM_RANGE
+    """
+    return min(HARDWARE_PWM_RANGE, int(round(width * frequency * HARDWARE_PWM_RANGE / 1000000.0)))
+
+
+class PigpioOutput:
+    """
+    通过 pigpiod 的 socket 接口输出 PWM 舵机脉宽
+
+    pigpio 库的每次 set_servo_pulsewidth 都是一次独立的 socket 往返. 这里把同一时刻的所有通道编码成连续的
+    指令一次发出, 再一次读回全部应答, 守护进程逐条连续执行, 通道越多节省的往返越多, 通道之间的时间差也越小.
+    通道默认使用 pigpio 的软件 PWM(DMA 定时, 频率 50Hz, 分辨率为采样周期, 默认 5 微秒),
+    gpio 12/13/18/19 可以切换为硬件 PWM, 频率可调, 脉宽按 1/HARDWARE_PWM_RANGE 的占空比输出.
+    """
+
+    def __init__(self, host=None, port=None):
+        """
+        :param host: pigpiod 地址, 默认取环境变量 PIGPIO_ADDR, 与 pigpio 库一致
+        :param port: pigpiod 端口, 默认取环境变量 PIGPIO_PORT
+        """
+        self.host = host or os.environ.get('PIGPIO_ADDR') or DEFAULT_HOST
+        self.port = int(port or os.environ.get('PIGPIO_PORT') or DEFAULT_PORT)
+        self.batches = 0  # 守护进程往返次数
+        self.updates = 0  # 输出的通道数
+        self.hardware = {}  # 使用硬件 PWM 的 gpio: 频率
+        self._sock = None
+        self._lock = threading.Lock()
+
+    def connect(self):
+        """
+        连接 pigpiod, 首次输出时会自动调用
+        :return: self
+        """
+        with self._lock:
+            if self._sock is None:
+                self._connect()
+        return self
+
+    def _connect(self):
+        # 需在持有 _lock 时调用
+        sock = socket.create_connection((self.host, self.port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._sock = sock
+
+    def close(self):
+        with self._lock:
+            if self._sock is not None:
+                self._sock.close()
+                self._sock = None
+
+    def _transact(self, request, count):
+        # 需在持有 _lock 时调用. 发出 count 条指令并读回 count 条应答
+        # 出错时关闭连接, 下一次输出会重新连接(如 pigpiod 重启后)
+        if self._sock is None:
+            self._connect()
+        sock = self._sock
+        size = count * _res_struct.size
+        reply = bytearray(size)
+        view = memoryview(reply)
+        received = 0
+        try:
+            sock.sendall(request)
+            while received < size:
+                n = sock.recv_into(view[received:])
+                if n == 0:
+                    raise ConnectionError("pigpiod closed the connection")
+                received += n
+        except BaseException:
+            sock.close()
+            self._sock = None
+            raise
+        self.batches += 1
+        bus_metrics.bytes_out += len(request)
+        bus_metrics.bytes_in += size
+        return reply
+
+    def set_pulsewidths(self, updates):
+        """
+        在一次往返中设置多个通道的脉宽
+        :param updates: (pin, width) 的列表, width 为 0 时关闭输出
+        :return: None
+        """
+        if not updates:
+            return
+        start = time.perf_counter()
+        with self._lock:
+            wait = time.perf_counter() - start
+            hardware = self.hardware
+            request = b''.join([_hp_struct.pack(PI_CMD_HP, pin, hardware[pin], 4, duty_cycle(width, hardware[pin]))
+                                if pin in hardware else _cmd_struct.pack(PI_CMD_SERVO, pin, width, 0)
+                                for pin, width in updates])
+            reply = self._transact(request, len(updates))
+            self.updates += len(updates)
+        errors = [(pin, width, res) for (pin, width), (_, _, _, res) in zip(updates, _res_struct.iter_unpack(reply))
+                  if res < 0]
+        bus_metrics.record('set_pulsewidths', time.perf_counter() - start, [u[0] for u in updates], wait,
+                           failed=bool(errors), failed_ids={e[0] for e in errors})
+        if errors:
+            pin, width, res = errors[0]
+            raise PigpioError("pigpio error %d setting pulse width %d on gpio %d" % (res, width, pin),
+                              [e[0] for e in errors])
+
+    def use_hardware_pwm(self, pin, frequency, width=0):
+        """
+        将通道切换为硬件 PWM, 守护进程拒绝时(如 gpio 不支持或通道被音频占用)保持软件 PWM
+        :param pin: gpio
+        :param frequency: 频率(Hz)
+        :param width: 切换后输出的脉宽(微秒)
+        :return: 是否已切换为硬件 PWM
+        """
+        if pin not in HARDWARE_PWM_PINS:
+            return False
+        request = (_cmd_struct.pack(PI_CMD_SERVO, pin, 0, 0) +
+                   _hp_struct.pack(PI_CMD_HP, pin, frequency, 4, duty_cycle(width, frequency)))
+        start = time.perf_counter()
+        with self._lock:
+            wait = time.perf_counter() - start
+            reply = self._transact(request, 2)
+            ok = _res_struct.unpack_from(reply, _res_struct.size)[3] >= 0
+            if ok:
+                self.hardware[pin] = frequency
+            else:
+                self._transact(_cmd_struct.pack(PI_CMD_SERVO, pin, width, 0), 1)
+        bus_metrics.record('use_hardware_pwm', time.perf_counter() - start, (pin,), wait, failed=not ok)
+        return ok
+
+    def use_software_pwm(self, pin, width=0):
+        """
+        将通道切换回软件 PWM
+        :param pin: gpio
+        :param width: 切换后输出的脉宽(微秒)
+        """
+        with self._lock:
+            if self.hardware.pop(pin, None) is not None:
+                request = _hp_struct.pack(PI_CMD_HP, pin, 0, 4, 0) + _cmd_struct.pack(PI_CMD_SERVO, pin, width, 0)
+                self._transact(request, 2)
+
+    def get_pulsewidth(self, pin):
+        """
+        :return: 通道当前的脉宽
+        """
+        start = time.perf_counter()
+        with self._lock:
+            wait = time.perf_counter() - start
+            reply = self._transact(_cmd_struct.pack(PI_CMD_GPW, pin, 0, 0), 1)
+        res = _res_struct.unpack(reply)[3]
+        bus_metrics.record('get_pulsewidth', time.perf_counter() - start, (pin,), wait, failed=res < 0)
+        return res
+
+    def stats(self):
+        return dict(batches=self.batches, updates=self.updates, hardware=dict(self.hardware))
+
+
+_output = None
+_output_lock = threading.Lock()
+
+
+def output():
+    """
+    PWM 舵机共用的输出, 首次调用时创建
+    """
+    global _output
+    if _output is None:
+        with _output_lock:
+            if _output is None:
+                _output = PigpioOutput()
+    return _output
+
+
+def use_output(new_output):
+    """
+    换用其它输出, 如 pigpio_emulator.VirtualPigpiod 连接的虚拟守护进程
+    :param new_output: 提供 set_pulsewidths(updates) 的对象
+    """
+    global _output
+    with _output_lock:
+        old, _output = _output, new_output
+    if old is not None and old is not new_output:
+        old.close()
+
+
+def close():
+    """
+    断开输出, 再次使用时会重新连接
+    """
+    global _output
+    with _output_lock:
+        old, _output = _output, None
+    if old is not None:
+        old.close()
@@ -21,10 +21,12 @@
 # ==============================================================================
 
 import time
+import select
 import struct
 import threading
-import serial
-from ._common import GPIO
+from . import _common
+from . import metrics
+from ._serial_servo_frame import FrameEncoder, pop_frame
 
 FRAME_HEADER = 0x55
 MOVE_TIME_WRITE = 1
@@ -56,13 +58,46 @@ LED_CTRL_READ = 34
 LED_ERROR_WRITE = 35
 LED_ERROR_READ = 36
 
+# 各读指令应答帧的参数格式
+_reply_structs = {cmd: struct.Struct(fmt) for cmd, fmt in {
+    MOVE_TIME_READ: "<hh",
+    MOVE_TIME_WAIT_READ: "<hh",
+    ID_READ: "<B",
+    ANGLE_OFFSET_READ: "<b",
+    ANGLE_LIMIT_READ: "<hh",
+    VIN_LIMIT_READ: "<hh",
+    TEMP_MAX_LIMIT_READ: "<B",
+    TEMP_READ: "<B",
+    VIN_READ: "<h",
+    POS_READ: "<h",
+    OR_MOTOR_MODE_READ: "<Bxh",
+    LOAD_OR_UNLOAD_READ: "<B",
+    LED_CTRL_READ: "<B",
+    LED_ERROR_READ: "<B",
+}.items()}
+
+_command_names = {v: k for k, v in globals().items()
+                  if k.endswith(('_WRITE', '_READ', '_ADJUST')) or k in ('MOVE_START', 'MOVE_STOP')}
+
+BROADCAST_ID = 0xFE
+REPLY_TIMEOUT = 0.01  # 单次读取等待应答的最长时间, 应答一般在 1ms 左右到达
+
 _rx_pin = 7
 _tx_pin = 13
-_serial_handle = serial.Serial("/dev/ttyAMA0", 115200)  # 初始化串口， 波特率为115200
+SERIAL_PORT = "/dev/ttyAMA0"
+BAUDRATE = 115200
+_serial_handle = None  # 由 port_open 打开, 首次读写时自动打开
+GPIO = None  # 由 port_init 初始化
 lock = threading.Lock()
+_encoder = FrameEncoder()  # 仅在持有 lock 时使用
+_arbiter = None  # 启用 bus_arbiter 后所有读写指令交由总线线程按优先级执行
+_direction_control = True  # 是否切换单线串口方向, 连接虚拟总线等全双工端口时关闭
+bus_metrics = metrics.BusMetrics('serial', _command_names)  # 收发字节与校验错误由 lock 保护
 
 
 def port_init():
+    global GPIO
+    GPIO = _common.gpio()
     GPIO.setup(_rx_pin, GPIO.OUT)  # 配置RX_CON 即 GPIO17 为输出
     GPIO.output(_rx_pin, 0)
     GPIO.setup(_tx_pin, GPIO.OUT)  # 配置TX_CON 即 GPIO27 为输出
@@ -70,13 +105,58 @@ def port_init():
 
 
 def port_as_write():  # 配置单线串口为输出
-    GPIO.output(_rx_pin, 0)  # 拉低RX_CON 即 GPIO17
-    GPIO.output(_tx_pin, 1)  # 拉高TX_CON 即 GPIO27
+    if _direction_control:
+        GPIO.output(_rx_pin, 0)  # 拉低RX_CON 即 GPIO17
+        GPIO.output(_tx_pin, 1)  # 拉高TX_CON 即 GPIO27
 
 
 def port_as_read():  # 配置单线串口为输入
-    GPIO.output(_tx_pin, 0)  # 拉低TX_CON 即 GPIO27
-    GPIO.output(_rx_pin, 1)  # 拉高RX_CON 即 GPIO17
+    if _direction_control:
+        GPIO.output(_tx_pin, 0)  # 拉低TX_CON 即 GPIO27
+        GPIO.output(_rx_pin, 1)  # 拉高RX_CON 即 GPIO17
+
+
+def port_open(port=SERIAL_PORT, baudrate=BAUDRATE):
+    """
+    打开串口并初始化单线串口方向控制引脚, 首次读写时会自动调用
+    :param port:
+    :param baudrate:
+    :return: serial.Serial
+    """
+    global _serial_handle
+    with lock:
+        if _serial_handle is None:
+            import serial
+            handle = serial.Serial(port, baudrate)  # 初始化串口， 波特率为115200
+            if _direction_control:
+                port_init()
+            _serial_handle = handle
+        return _serial_handle
+
+
+def port_close():
+    """
+    关闭串口, 再次读写时会重新打开
+    """
+    global _serial_handle
+    with lock:
+        if _serial_handle is not None:
+            _serial_handle.close()
+            _serial_handle = None
+
+
+def use_port(handle, direction_control=True):
+    """
+    换用其它串口, 如 servo_emulator.VirtualServoBus 提供的虚拟总线
+    :param handle: serial.Serial 对象
+    :param direction_control: 是否通过 GPIO 切换单线串口方向
+    """
+    global _serial_handle, _direction_control
+    with lock:
+        _serial_handle = handle
+        _direction_control = direction_control
+        if direction_control:
+            port_init()
 
 
 def port_reset():
@@ -88,6 +168,31 @@ def port_reset():
     time.sleep(0.1)
 
 
+def _write_cmd(id_, cmd, params=None):
+    # 需在持有 lock 时调用
+    frame = _encoder.encode(id_, cmd, params)
+    port_as_write()
+    _serial_handle.write(frame)  # write
+    bus_metrics.bytes_out += len(frame)
+
+
+def _write_cmds(cmds):
+    # 需在持有 lock 时调用
+    burst = _encoder.encode_burst(cmds)
+    if burst:
+        port_as_write()
+        _serial_handle.write(burst)  # write
+        bus_metrics.bytes_out += len(burst)
+
+
+def _write_frames(data):
+    # 需在持有 lock 时调用
+    if data:
+        port_as_write()
+        _serial_handle.write(data)  # write
+        bus_metrics.bytes_out += len(data)
+
+
 def write_cmd(id_, cmd, params=None):
     """
     写指令
@@ -96,67 +201,162 @@ def write_cmd(id_, cmd, params=None):
     :param params:
     :return: None
     """
+    if _serial_handle is None:
+        port_open()
+    start = time.perf_counter()
+    arbiter = _arbiter  # 只读一次, bus_arbiter.stop() 可能同时把它置为 None
+    if arbiter is not None:
+        arbiter.call((cmd,), _write_cmd, id_, cmd, params)
+        bus_metrics.record(cmd, time.perf_counter() - start, (id_,))
+        return
     with lock:
-        port_as_write()
-        # 写数据
-        params_buf = []
-        if isinstance(params, list):
-            for p in params:
-                params_buf.extend([p % 256, p // 256 % 256])  # 分低8位 高8位 放入缓存
-        else:
-            if isinstance(params, int) and 0 <= params < 256:
-                params_buf.append(params)
-        buf = [0x55, 0x55, id_, len(params_buf) + 3 if params else 3, cmd]
-        buf.extend(params_buf)
-        buf.append(255 - (sum(buf[2:]) % 256))
-        _serial_handle.write(bytes(buf))  # write
+        wait = time.perf_counter() - start
+        _write_cmd(id_, cmd, params)
+    bus_metrics.record(cmd, time.perf_counter() - start, (id_,), wait)
+
+
+def write_cmds(cmds):
+    """
+    批量写指令, 所有帧编码到同一缓存后在一次加锁、一次方向切换内发出
+    统计中整批记为第一条指令的一次操作
+    :param cmds: (id_, cmd, params) 的列表
+    :return: None
+    """
+    if _serial_handle is None:
+        port_open()
+    if not cmds:
+        return
+    start = time.perf_counter()
+    arbiter = _arbiter
+    if arbiter is not None:
+        arbiter.call([c[1] for c in cmds], _write_cmds, cmds)
+        wait = None
+    else:
+        with lock:
+            wait = time.perf_counter() - start
+            _write_cmds(cmds)
+    bus_metrics.record(cmds[0][1], time.perf_counter() - start, [c[0] for c in cmds], wait)
+
+
+def write_frames(data, cmd=MOVE_TIME_WRITE):
+    """
+    写入已编码好的帧, 如 action_set.ActionSet.compile() 预先生成的指令
+    :param data: 一帧或连续多帧的 bytes
+    :param cmd: 帧中的指令, 启用 bus_arbiter 时用于确定优先级
+    :return: None
+    """
+    if _serial_handle is None:
+        port_open()
+    start = time.perf_counter()
+    arbiter = _arbiter
+    if arbiter is not None:
+        arbiter.call((cmd,), _write_frames, data)
+        wait = None
+    else:
+        with lock:
+            wait = time.perf_counter() - start
+            _write_frames(data)
+    bus_metrics.record(cmd, time.perf_counter() - start, (), wait)
 
 
 def send_read_cmd(id_=None, cmd=None):
     """
-    发送读取命令
+    发送读取命令, 需在持有 lock 时调用
     :param id_:
     :param cmd:
     :return:
     """
+    frame = _encoder.encode(id_, cmd)
     port_as_write()
-    buf = [0x55, 0x55, id_, 3, cmd, 0x00]
-    buf[-1](255 - (sum(buf[2:-1]) % 256))
-    _serial_handle.write(buf)  # 发送
-    time.sleep(0.00034)
+    _serial_handle.write(frame)  # 发送
+    _serial_handle.flush()  # 等待发送完毕再切换方向
+    bus_metrics.bytes_out += len(frame)
+
+
+def _parse_reply(recv_data, id_, cmd, errors=None):
+    """
+    从接收缓存中解析应答
+    :param recv_data: bytearray 接收缓存, 已解析的字节会被删除
+    :param id_: 舵机id, 为广播id时不校验应答帧中的id
+    :param cmd: 读取命令
+    :param errors: 校验错误计数, 见 pop_frame
+    :return: 数据, 还未收到匹配的应答时返回 None
+    """
+    reply_struct = _reply_structs[cmd]
+    frame = pop_frame(recv_data, errors)
+    while frame is not None:
+        recv_id, recv_cmd, params = frame
+        if recv_cmd == cmd and (id_ == BROADCAST_ID or recv_id == id_) and len(params) == reply_struct.size:
+            return reply_struct.unpack(params)
+        frame = pop_frame(recv_data, errors)
+    return None
 
 
-def _read_msg_base(cmd):
+def _read_msg_base(id_, cmd, timeout=REPLY_TIMEOUT):
     """
     # 获取指定读取命令的数据
+    在截止时间内等待应答, 收到完整且校验正确的应答帧即返回, 收到杂散字节时在帧头处重新同步
+    :param id_: 舵机id, 为广播id时不校验应答帧中的id
     :param cmd: 读取命令
-    :return: 数据
+    :param timeout: 最长等待时间(秒)
+    :return: 数据, 超时返回 None
     """
+    deadline = time.monotonic() + timeout
+    fd = _serial_handle.fileno()
+    recv_data = bytearray()
+    errors = [0]
+    received = 0
     _serial_handle.flushInput()  # 清空接收缓存
     port_as_read()  # 将单线串口配置为输入
-    time.sleep(0.005)  # 稍作延时，等待接收完毕
-    recv_len = _serial_handle.inWaiting()  # 获取接收缓存中的字节数
-    if recv_len < 5:
-        return None
-    # for i in recv_data:
-    #     print('%#x' %ord(i))
-
-    recv_data = _serial_handle.read(recv_len)  # 读取接收到的数据
-    cmd_len = recv_data[3]
-    if recv_data[0] != FRAME_HEADER or recv_data[1] != FRAME_HEADER or cmd != recv_data[3]:
-        return None
-    if cmd_len == 3:
-        return True
-    elif cmd_len + 2 <= recv_len:
-        return struct.unpack({4: "<c", 5: "<h", 7: "<hh"}[cmd_len], recv_data[5: 5 + cmd_len - 3])
-    else:
-        return None
-
-
-def read_msg(id_, cmd, retry=50):
-    for i in range(retry):
-        with lock:
-            send_read_cmd(id_, cmd)
-            msg = _read_msg_base(cmd)
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                return None
+            data = _serial_handle.read(_serial_handle.inWaiting() or 1)  # 读取接收到的数据
+            received += len(data)
+            recv_data += data
+            msg = _parse_reply(recv_data, id_, cmd, errors)
             if msg is not None:
                 return msg
+    finally:
+        bus_metrics.bytes_in += received
+        if errors[0]:
+            bus_metrics.count_checksum_errors(id_, errors[0])
+
+
+def _read_once(id_, cmd, timeout=REPLY_TIMEOUT):
+    # 需在持有 lock 时调用
+    send_read_cmd(id_, cmd)
+    return _read_msg_base(id_, cmd, timeout)
+
+
+def read_msg(id_, cmd, retry=50, timeout=REPLY_TIMEOUT):
+    """
+    发送读取命令并等待应答, 每次尝试之间释放总线锁
+    :param id_:
+    :param cmd: 读取命令
+    :param retry: 最多尝试次数
+    :param timeout: 每次尝试等待应答的最长时间(秒)
+    :return: 数据, 全部失败返回 None
+    """
+    if _serial_handle is None:
+        port_open()
+    start = time.perf_counter()
+    wait = None  # 各次尝试等待 lock 的时间之和, 经 bus_arbiter 排队时不统计
+    attempts = 0
+    msg = None
+    for attempts in range(1, retry + 1):
+        arbiter = _arbiter
+        if arbiter is not None:
+            # 每次尝试单独排队, 高优先级的指令可以插在两次重试之间
+            msg = arbiter.call((cmd,), _read_once, id_, cmd, timeout, expire_ok=True)
+        else:
+            t = time.perf_counter()
+            with lock:
+                wait = (wait or 0.0) + time.perf_counter() - t
+                msg = _read_once(id_, cmd, timeout)
+        if msg is not None:
+            break
+    bus_metrics.record(cmd, time.perf_counter() - start, (id_,), wait, max(attempts - 1, 0), msg is None)
+    return msg
@@ -0,0 +1,183 @@
+# This file is part of rsp_robot_hat_v3.
+# Copyright (C) 2021 Hiwonder Ltd. <support@hiwonder.com>
+#
+# rsp_robot_hat_v3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rsp_robot_hat_v3 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# title           :_serial_servo_frame.py
+# author          :Hiwonder, LuYongping(Lucas)
+# date            :20261018
+# notes           :
+# ==============================================================================
+
+import struct
+
+FRAME_HEADER = 0x55
+
+_BYTE_PARAM = -1
+
+
+class FrameEncoder:
+    """
+    串口舵机指令帧编码器
+
+    每个 (id, cmd, 参数形式) 的帧头与整帧的预编译 struct.Struct 会被缓存, 校验和由帧头部分的缓存和
+    与参数字节和累加得到, 编码结果直接写入可复用的 bytearray, 不再为每帧创建临时列表.
+    参数形式与原 write_cmd 相同: 列表中每个参数编码为低8位+高8位, 0~255 的整数编码为一个字节, 其余不带参数.
+    返回的 memoryview 在下一次编码前有效, 多线程共用时需由调用者加锁.
+    """
+
+    def __init__(self, size=128):
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        self._templates = {}
+
+    def _template(self, key):
+        id_, cmd, shape = key
+        if shape == _BYTE_PARAM:
+            n_bytes, fmt = 1, 'B'
+        else:
+            n_bytes, fmt = shape * 2, '%dH' % shape
+        length = n_bytes + 3
+        header = bytes((FRAME_HEADER, FRAME_HEADER, id_, length, cmd))
+        template = (struct.Struct('<5s' + fmt + 'B'), header, (id_ + length + cmd) & 0xFF, length + 3)
+        self._templates[key] = template
+        return template
+
+    def _reserve(self, size):
+        # 换用新的缓存而不是原地扩容, 调用者手中尚未释放的旧 memoryview 仍然有效
+        buf = bytearray(max(size, len(self._buf) * 2))
+        buf[:len(self._buf)] = self._buf
+        self._buf = buf
+        self._view = memoryview(buf)
+
+    def encode_into(self, offset, id_, cmd, params=None):
+        """
+        将一帧编码到内部缓存的 offset 处
+        :param offset: 写入位置
+        :param id_:
+        :param cmd:
+        :param params:
+        :return: 下一帧的写入位置
+        """
+        if isinstance(params, list):
+            shape = len(params)
+        elif isinstance(params, int) and 0 <= params < 256:
+            shape = _BYTE_PARAM
+        else:
+            shape = 0
+        key = (id_, cmd, shape)
+        template = self._templates.get(key)
+        if template is None:
+            template = self._template(key)
+        frame_struct, header, checksum, frame_len = template
+        end = offset + frame_len
+        if end > len(self._buf):
+            self._reserve(end)
+        if shape == 2:
+            p0 = params[0] & 0xFFFF
+            p1 = params[1] & 0xFFFF
+            checksum += (p0 & 0xFF) + (p0 >> 8) + (p1 & 0xFF) + (p1 >> 8)
+            frame_struct.pack_into(self._buf, offset, header, p0, p1, ~checksum & 0xFF)
+        elif shape == _BYTE_PARAM:
+            frame_struct.pack_into(self._buf, offset, header, params, ~(checksum + params) & 0xFF)
+        elif shape:
+            words = [p & 0xFFFF for p in params]
+            for w in words:
+                checksum += (w & 0xFF) + (w >> 8)
+            frame_struct.pack_into(self._buf, offset, header, *words, ~checksum & 0xFF)
+        else:
+            frame_struct.pack_into(self._buf, offset, header, ~checksum & 0xFF)
+        return end
+
+    def encode(self, id_, cmd, params=None):
+        """
+        编码一帧
+        :return: 指向内部缓存的 memoryview
+        """
+        return self._view[:self.encode_into(0, id_, cmd, params)]
+
+    def encode_burst(self, cmds):
+        """
+        将多帧依次编码到同一缓存
+        :param cmds: (id_, cmd, params) 的可迭代对象
+        :return: 指向内部缓存的 memoryview
+        """
+        buf = self._buf
+        templates = self._templates
+        end = 0
+        for id_, cmd, params in cmds:
+            if params.__class__ is list and len(params) == 2:
+                # 位置指令等两个参数的帧是热点, 在循环内直接编码
+                template = templates.get((id_, cmd, 2))
+                if template is None:
+                    template = self._template((id_, cmd, 2))
+                frame_struct, header, checksum, frame_len = template
+                if end + frame_len > len(buf):
+                    self._reserve(end + frame_len)
+                    buf = self._buf
+                p0 = params[0] & 0xFFFF
+                p1 = params[1] & 0xFFFF
+                checksum += (p0 & 0xFF) + (p0 >> 8) + (p1 & 0xFF) + (p1 >> 8)
+                frame_struct.pack_into(buf, end, header, p0, p1, ~checksum & 0xFF)
+                end += frame_len
+            else:
+                end = self.encode_into(end, id_, cmd, params)
+                buf = self._buf
+        return self._view[:end]
+
+    def frame(self, id_, cmd, params=None):
+        """
+        编码一帧并返回独立的 bytes 对象
+        """
+        return self.encode(id_, cmd, params).tobytes()
+
+
+_HEADER = bytes((FRAME_HEADER, FRAME_HEADER))
+MAX_LENGTH = 7  # 协议中最长的帧为 4 字节参数, 长度字节为 7
+
+
+def pop_frame(buf, errors=None):
+    """
+    从接收缓存中取出第一个校验正确的数据帧
+    帧头之前的杂散字节、长度非法或校验错误的帧会被丢弃, 并在下一个 0x55 0x55 处重新同步
+
+    :param buf: bytearray 接收缓存, 已解析或丢弃的字节会从中删除
+    :param errors: 长度为 1 的列表, 每丢弃一个校验错误的帧 errors[0] 加 1
+    :return: (id_, cmd, params) params 为 bytes, 缓存中还没有完整的帧时返回 None
+    """
+    while True:
+        start = buf.find(_HEADER)
+        if start < 0:
+            # 末尾的 0x55 可能是下一帧帧头的一部分, 予以保留
+            del buf[:-1 if buf[-1:] == _HEADER[:1] else len(buf)]
+            return None
+        if start:
+            del buf[:start]
+        if len(buf) < 4:
+            return None
+        length = buf[3]
+        if not 3 <= length <= MAX_LENGTH:
+            del buf[:1]
+            continue
+        end = length + 3
+        if len(buf) < end:
+            return None
+        if ~sum(buf[2:end - 1]) & 0xFF != buf[end - 1]:
+            if errors is not None:
+                errors[0] += 1
+            del buf[:1]
+            continue
+        frame = (buf[2], buf[4], bytes(buf[5:end - 1]))
+        del buf[:end]
+        return frame
@@ -21,47 +21,461 @@
 # ==============================================================================
 
 import os
+import sys
 import asyncio
 import threading
+import contextlib
+import collections
+import concurrent.futures
 import sqlite3 as sql
-from .serial_servo import set_position
+from array import array
+from . import trajectory
+from . import serial_servo as _serial_servo
+from . import _serial_servo_commands as _ssc
+from ._serial_servo_frame import FrameEncoder
+from .serial_servo_aio import write_frames
 from .misc import empty_func as _empty_func
+from .bus_arbiter import DeadlineExceeded
+
+
+class ActionCache:
+    """
+    进程内共用的动作组数据缓存
+
+    以 (路径, 修改时间, 文件大小) 为键缓存解析后的动作数据, 文件被改动后自动重新读取.
+    缓存的总大小超过 budget 时按最近最少使用的顺序淘汰. 缓存的动作数据是元组, 各处共用, 不要修改.
+    """
+
+    def __init__(self, budget=16 * 1024 * 1024):
+        """
+        :param budget: 缓存占用内存的上限(字节), 单个超过上限的文件不缓存
+        """
+        self.budget = budget
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()  # {路径: (修改时间, 文件大小, 动作数据, 占用内存)}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _read(path):
+        with sql.connect(path) as ag:
+            action_data = tuple(ag.execute("select * from ActionGroup"))
+        size = sys.getsizeof(action_data)
+        for act in action_data:
+            size += sys.getsizeof(act) + sum(map(sys.getsizeof, act))
+        return action_data, size
+
+    def get(self, path):
+        """
+        取得动作组数据, 缓存未命中时读取文件
+        :param path: 动作组文件路径
+        :return: 动作数据元组, 每项为 (Index, Time, Servo1, Servo2...)
+        """
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+                self._entries.move_to_end(path)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+        action_data, size = self._read(path)
+        with self._lock:
+            old = self._entries.pop(path, None)
+            if old is not None:
+                self.size -= old[3]
+            if size <= self.budget:
+                self._entries[path] = (st.st_mtime_ns, st.st_size, action_data, size)
+                self.size += size
+                while self.size > self.budget:
+                    self.size -= self._entries.popitem(last=False)[1][3]
+                    self.evictions += 1
+        return action_data
+
+    def preload(self, paths):
+        """
+        预先读取动作组文件
+        :param paths: 动作组文件路径的列表
+        """
+        for path in paths:
+            self.get(path)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """
+        :return: {entries, size, budget, hits, misses, evictions}
+        """
+        return dict(entries=len(self._entries), size=self.size, budget=self.budget,
+                    hits=self.hits, misses=self.misses, evictions=self.evictions)
+
+
+action_cache = ActionCache()
+
+
+def preload(paths):
+    """
+    预先读取动作组文件到缓存, 之后的播放不再访问文件
+    :param paths: 动作组文件路径的列表
+    """
+    action_cache.preload(paths)
+
+
+class CompiledActionSet:
+    """
+    编译后的动作组, 第 i 项为 (时间, 该动作所有舵机位置指令帧的 bytes)
+
+    时间、位置和各动作在 frames 中的偏移都保存在 array 中, 所有帧连续保存在一个 bytes 中,
+    播放时每个动作只需一次串口写入.
+    """
+    __slots__ = ('ids', 'durations', 'positions', 'offsets', 'frames', 'speed', '_view')
+
+    def __init__(self, ids, durations, positions, offsets, frames, speed=1.0):
+        self.ids = ids  # 各列对应的舵机id
+        self.durations = durations  # array('H'), 毫秒
+        self.positions = positions  # array('H'), 依次为每个动作中 ids 中各舵机的位置
+        self.offsets = offsets  # array('I'), 第 i 个动作的帧在 frames[offsets[i]:offsets[i + 1]]
+        self.frames = frames
+        self.speed = speed  # 编译时的播放速度倍数
+        self._view = memoryview(frames)
+
+    def __len__(self):
+        return len(self.durations)
+
+    def __getitem__(self, i):
+        return self.durations[i], self._view[self.offsets[i]:self.offsets[i + 1]]
+
+    def __iter__(self):
+        frames, offsets = self._view, self.offsets
+        for i, duration in enumerate(self.durations):
+            yield duration, frames[offsets[i]:offsets[i + 1]]
+
+    def pose(self, i):
+        """
+        :return: 第 i 个动作中各舵机的位置
+        """
+        n = len(self.ids)
+        return self.positions[i * n:(i + 1) * n]
+
+
+# 播放落后于时间表时的处理方式
+CATCH_UP = 'catch_up'  # 保持原时间表, 立即连续发出落后的动作直到追上
+SKIP = 'skip'  # 保持原时间表, 跳过在计划中已经结束的动作, 每轮的最后一个动作不跳过
+RESYNC = 'resync'  # 以当前时刻为准重新排定之后的动作, 之后的动作保持原有间隔
+POLICIES = (CATCH_UP, SKIP, RESYNC)
+
+
+class PlaybackStats:
+    """
+    一次动作组播放的时间统计, 时间单位均为秒
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.frames = 0  # 发出的动作数
+        self.skipped = 0  # 跳过的动作数
+        self.expired = 0  # 在总线仲裁器中等待超过期限而没有发出的动作数, 见 bus_arbiter.DeadlineExceeded
+        self.lateness = array('d')  # 每个发出的动作相对计划时刻的延迟
+        self.max_drift = 0.0  # 最大延迟
+        self.total_drift = 0.0  # 延迟之和
+        self.elapsed = 0.0  # 实际用时
+        self.expected = 0.0  # 按动作时间计算的用时
+
+    def add(self, lateness):
+        self.frames += 1
+        self.lateness.append(lateness)
+        self.total_drift += lateness
+        if lateness > self.max_drift:
+            self.max_drift = lateness
+
+    def as_dict(self):
+        return dict(path=self.path, frames=self.frames, skipped=self.skipped, expired=self.expired,
+                    max_drift=self.max_drift, total_drift=self.total_drift,
+                    elapsed=self.elapsed, expected=self.expected)
+
+    def __repr__(self):
+        return "PlaybackStats(%s)" % ', '.join('%s=%r' % item for item in self.as_dict().items())
 
 
 class ActionSet:
-    def __init__(self, path, repeat=1, lock_servos=None):
+    def __init__(self, path, repeat=1, lock_servos=None, profile=None, policy=CATCH_UP, stream=False, servos=None):
+        """
+        :param path: 动作组文件路径
+        :param repeat: 重复次数
+        :param lock_servos: {id_: 位置}, 这些舵机在所有动作中都保持在指定位置
+        :param profile: 动作之间的速度曲线, 见 trajectory.PROFILES. 为 None 时由舵机自行匀速转动
+        :param policy: 播放落后于时间表时的处理方式, 见 POLICIES
+        :param stream: 播放时从文件中分块读取, 不经过 action_cache, 用于很大的动作组文件
+        :param servos: 依次与动作组各列对应的舵机id, 多出的列不播放. 为 None 时第 i 列对应 i 号舵机
+        """
         if not os.path.exists(path):
             raise FileNotFoundError(path)
+        if profile is not None and profile not in trajectory.PROFILES:
+            raise ValueError("unknown profile %r, it must be one of %s" % (profile, ', '.join(trajectory.PROFILES)))
+        if policy not in POLICIES:
+            raise ValueError("unknown policy %r, it must be one of %s" % (policy, ', '.join(POLICIES)))
         self.path = path
         self.repeat = repeat
         self.lock_servos = lock_servos if lock_servos else dict()
+        self.profile = profile
+        self.policy = policy
+        self.stream = stream
+        self.servos = tuple(servos) if servos is not None else None
         self.action_data = []
+        self._compiled = {}  # {速度: (动作数据, lock_servos, 编译结果)}
+
+    def load(self):
+        """
+        :return: 动作数据, 通过 action_cache 读取
+        """
+        return action_cache.get(self.path)
+
+    def compile(self, speed=1.0):
+        """
+        将动作数据编译为可直接发送的指令帧. 被 lock 的舵机替换为指定位置, 位置和时间限制在舵机的范围内.
+        动作数据和 lock_servos 不变时返回上次的结果
+        :param speed: 播放速度倍数, 动作时间除以该值
+        :return: CompiledActionSet
+        """
+        action_data = self.load()
+        lock_servos = tuple(sorted(self.lock_servos.items()))
+        compiled = self._compiled.get(speed)
+        if compiled is not None and compiled[0] is action_data and compiled[1] == lock_servos:
+            return compiled[2]
+
+        result = _compile_rows(action_data, lock_servos, self.servos, speed)
+        self.action_data = action_data
+        self._compiled[speed] = (action_data, lock_servos, result)
+        return result
+
+    def servo_ids(self):
+        """
+        :return: 播放时驱动的舵机id
+        """
+        if self.servos is not None:
+            return self.servos
+        with contextlib.closing(sql.connect(self.path)) as ag:
+            columns = len(ag.execute("pragma table_info(ActionGroup)").fetchall())
+        return tuple(range(1, columns - 1))
+
+
+def _compile_rows(rows, lock_servos, ids=None, speed=1.0):
+    """
+    :param rows: ActionGroup 表中的行
+    :param lock_servos: (id_, 位置) 的序列
+    :param ids: 依次与各列对应的舵机id, 为 None 时第 i 列对应 i 号舵机
+    :param speed: 播放速度倍数
+    :return: CompiledActionSet
+    """
+    columns = len(rows[0]) - 2 if rows else 0
+    if ids is None:
+        ids = tuple(range(1, columns + 1))
+    elif rows and len(ids) > columns:
+        raise ValueError("%d servos given but the action group has only %d columns" % (len(ids), columns))
+    columns = {id_: i for i, id_ in enumerate(ids)}
+    lock_servos = [(columns[id_], lock_pos) for id_, lock_pos in lock_servos if id_ in columns]
+    n = len(ids)
+    encoder = FrameEncoder()
+    durations, positions, offsets, frames = array('H'), array('H'), array('I', [0]), bytearray()
+    for act in rows:
+        pos_set = list(act[2:2 + n])
+        # 将所有动作里面被lock的舵机的角度设为指定lock的角度
+        for i, lock_pos in lock_servos:
+            pos_set[i] = lock_pos
+        pos_set = [min(max(int(pos), 0), 1000) for pos in pos_set]
+        duration = min(max(int(act[1] / speed), 0), 30000)
+        frames += encoder.encode_burst([(id_, _ssc.MOVE_TIME_WRITE, [pos, duration])
+                                        for id_, pos in zip(ids, pos_set)])
+        durations.append(duration)
+        positions.extend(pos_set)
+        offsets.append(len(frames))
+    return CompiledActionSet(ids, durations, positions, offsets, bytes(frames), speed)
+
+
+STREAM_FIRST_CHUNK = 16  # 流式播放第一次读取的动作数, 较小以便尽快开始播放
+STREAM_CHUNK = 256  # 流式播放之后每次读取的动作数
+STREAM_PREFETCH = 2  # 流式播放预读的块数
+
+
+def _count_actions(path):
+    with contextlib.closing(sql.connect(path)) as ag:
+        return ag.execute("select count(*) from ActionGroup").fetchone()[0]
+
+
+async def _stream_chunks(action_set, control=None):
+    """
+    从 SQLite 游标分块读取并编译动作, 读取和编译在单独的线程中进行并预读 STREAM_PREFETCH 块,
+    占用的内存与文件大小无关
+    :param control: PlaybackHandle, 每块按编译时的播放速度编译
+    :return: 依次产生 CompiledActionSet 的异步生成器
+    """
+    loop = asyncio.get_running_loop()
+    lock_servos = tuple(sorted(action_set.lock_servos.items()))
+    executor = concurrent.futures.ThreadPoolExecutor(1)  # 连接只在这一个线程中使用
+    queue = asyncio.Queue(STREAM_PREFETCH)
+    state = {}
+
+    def open_cursor():
+        state['ag'] = sql.connect(action_set.path, check_same_thread=False)
+        state['cursor'] = state['ag'].execute("select * from ActionGroup")
+
+    def read_chunk(size):
+        rows = state['cursor'].fetchmany(size)
+        speed = control.speed if control is not None else 1.0
+        return _compile_rows(rows, lock_servos, action_set.servos, speed) if rows else None
+
+    def close():
+        if 'ag' in state:
+            state['ag'].close()
+
+    async def producer():
+        await loop.run_in_executor(executor, open_cursor)
+        size = STREAM_FIRST_CHUNK
+        while True:
+            chunk = await loop.run_in_executor(executor, read_chunk, size)
+            await queue.put(chunk)
+            if chunk is None:
+                return
+            size = STREAM_CHUNK
+
+    task = loop.create_task(producer())
+    try:
+        while True:
+            chunk = await queue.get()
+            if chunk is None:
+                break
+            yield chunk
+        await task
+    finally:
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+        executor.submit(close)
+        executor.shutdown(wait=False)
+
+
+async def _chunks(action_set, compiled, control):
+    if compiled is None:
+        async for chunk in _stream_chunks(action_set, control):
+            yield chunk
+    else:
+        yield compiled
+
+
+PROFILE_RATE = 50  # 按速度曲线细分动作时的指令频率(Hz)
+
+
+async def _sleep_until(loop, deadline):
+    delay = deadline - loop.time()
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+
+async def _move_profiled(start, ids, last_pos, pos_set, duration, profile, emit):
+    """
+    按速度曲线将一个动作细分为多段短动作, 从 start 起按固定间隔依次发出
+    :param start: 动作开始的时刻(事件循环时钟)
+    :param ids: 舵机id
+    :param last_pos: 上一个动作的位置
+    :param pos_set: 本动作的位置
+    :param duration: 动作时间(毫秒)
+    :param profile: 速度曲线
+    :param emit: 写入指令帧的协程函数
+    """
+    loop = asyncio.get_running_loop()
+    encoder = FrameEncoder()
+    tables = [trajectory.profile(p - q, duration, profile, PROFILE_RATE) for p, q in zip(pos_set, last_pos)]
+    step = 1.0 / PROFILE_RATE
+    step_ms = int(1000 * step)
+    for i in range(1, len(tables[0])):
+        await _sleep_until(loop, start + (i - 1) * step)
+        cmds = _serial_servo._move_cmds([(id_, q + int(t[i]), step_ms) for id_, q, t in zip(ids, last_pos, tables)])
+        await emit(encoder.encode_burst(cmds).tobytes())
+
+
+async def _play(action_set, compiled, control=None, emit=write_frames, start=None):
+    """
+    按绝对时间表播放一个动作组, 第 k 个动作的计划时刻为开始时刻加上之前所有动作的时间, 写入和调度的耗时不会累积
+    :param compiled: 编译后的动作组, 为 None 时流式播放
+    :param control: PlaybackHandle, 提供暂停和速度调节
+    :param emit: 写入指令帧的协程函数
+    :param start: 开始时刻(事件循环时钟), 默认为当前时刻
+    :return: PlaybackStats
+    """
+    loop = asyncio.get_running_loop()
+    stats = PlaybackStats(action_set.path)
+    policy = action_set.policy
+    if compiled is None:
+        total = await loop.run_in_executor(None, _count_actions, action_set.path) if policy == SKIP else 0
+    else:
+        total = len(compiled)
+    start = deadline = loop.time() if start is None else start
+    last_pos = None
+    for i in range(action_set.repeat):
+        index = 0
+        async for chunk in _chunks(action_set, compiled, control):
+            if i == 0 and _serial_servo.config_cache.enabled:
+                for id_ in chunk.ids:
+                    _serial_servo.config_cache.invalidate(id_, _ssc.LOAD_OR_UNLOAD_READ)
+            k = 0
+            while k < len(chunk):
+                if control is not None:
+                    if not control._running.is_set():
+                        # 暂停的时间不计入时间表
+                        paused_at = loop.time()
+                        await control._running.wait()
+                        deadline += loop.time() - paused_at
+                    if compiled is not None and control.speed != chunk.speed:
+                        # 之后的各轮也使用新速度编译的结果
+                        chunk = compiled = await loop.run_in_executor(None, action_set.compile, control.speed)
+                duration, frames = chunk[k]
+                k += 1
+                index += 1
+                stats.expected += duration / 1000.0
+                now = loop.time()
+                late = now - deadline
+                if late > 0:
+                    if policy == SKIP and index < total and now >= deadline + duration / 1000.0:
+                        # 本动作在计划中已经结束
+                        stats.skipped += 1
+                        deadline += duration / 1000.0
+                        continue
+                    if policy == RESYNC:
+                        deadline = now
+                try:
+                    if action_set.profile is None or last_pos is None or duration <= 0:
+                        await emit(frames)
+                    else:
+                        await _move_profiled(deadline, chunk.ids, last_pos, chunk.pose(k - 1), duration,
+                                             action_set.profile, emit)
+                except DeadlineExceeded:
+                    stats.expired += 1
+                else:
+                    stats.add(late)
+                last_pos = chunk.pose(k - 1)
+                deadline += duration / 1000.0
+                await _sleep_until(loop, deadline)
+    stats.elapsed = loop.time() - start
+    return stats
 
 
 async def _run_action_set(action_sets: tuple):
     """
     :param action_sets: The path of the action set you want to run
-    :return:
+    :return: 每个动作组的 PlaybackStats 的列表
     """
-    for action_set in action_sets:
-        # 从动作组文件中取出动作数据
-        with sql.connect(action_set.path) as ag:
-            action_data = ag.execute("select * from ActionGroup").fetchall()
-        # 对动作数据做些处理
-        # 将所有动作里面被lock的舵机的角度设为指定lock的角度
-        for id_, lock_pos in action_set.lock_servos.items():
-            for act in action_data:
-                act[1 + id_] = lock_pos
-        action_set.action_data = action_data
+    compiled_sets = [None if action_set.stream else action_set.compile() for action_set in action_sets]
+    return [await _play(action_set, compiled) for action_set, compiled in zip(action_sets, compiled_sets)]
 
-    for action_set in action_sets:
-        for i in range(action_set.repeat):
-            for action in action_set.action_data:
-                duration = action[1]
-                pos_set = action[2:]
-                for id_, pos in enumerate(pos_set, 1):
-                    set_position(id_, pos, duration)
-                await asyncio.sleep(duration / 1000.0)
+
+async def _run_one(action_set):
+    return (await _run_action_set((action_set,)))[0]
 
 
 def run_action_set(action_set, block=True, done_callback=_empty_func):
@@ -71,12 +485,12 @@ def run_action_set(action_set, block=True, done_callback=_empty_func):
     :param action_set: The path of the action set you want to run
     :param block:
     :param done_callback:
-    :return:
+    :return: block 为 True 时返回 PlaybackStats, 否则返回结果为 PlaybackStats 的 Future
     """
     if block:
-        asyncio.run(_run_action_set((action_set,)))
+        return asyncio.run(_run_one(action_set))
     else:
-        f = asyncio.run_coroutine_threadsafe(_run_action_set((action_set,)), _loop)
+        f = asyncio.run_coroutine_threadsafe(_run_one(action_set), _get_loop())
         f.add_done_callback(done_callback)
         return f
 
@@ -88,20 +502,212 @@ def run_multi_action_sets(action_sets, block=True, done_callback=_empty_func):
     :param action_sets: 要允许的动作组及运行
     :param block:
     :param done_callback:
-    :return:
+    :return: block 为 True 时返回每个动作组的 PlaybackStats 的列表, 否则返回结果为该列表的 Future
     """
     if block:
-        asyncio.run(_run_action_set(action_sets))
+        return asyncio.run(_run_action_set(action_sets))
     else:
-        f = asyncio.run_coroutine_threadsafe(_run_action_set(action_sets), _loop)
+        f = asyncio.run_coroutine_threadsafe(_run_action_set(action_sets), _get_loop())
         f.add_done_callback(done_callback)
         return f
 
 
+class PlaybackHandle:
+    """
+    PlaybackManager 中一个正在播放的动作组, 方法可以在任意线程中调用
+    """
+
+    def __init__(self, manager, action_set, servos, speed):
+        self.manager = manager
+        self.action_set = action_set
+        self.servos = servos  # 占用的舵机id
+        self.speed = speed
+        self.future = None  # 结果为 PlaybackStats 的 concurrent.futures.Future
+        self._paused = False
+        self._running = None  # asyncio.Event, 在后台事件循环中创建, 暂停时清除
+
+    def _apply_pause(self):
+        if self._running is not None:
+            if self._paused:
+                self._running.clear()
+            else:
+                self._running.set()
+
+    def cancel(self):
+        """
+        停止播放, 舵机停在已发出的最后一个动作
+        """
+        self.future.cancel()
+
+    def pause(self):
+        """
+        暂停, 在下一个动作开始前生效, 恢复后之后的动作顺延
+        """
+        self._paused = True
+        self.manager._loop.call_soon_threadsafe(self._apply_pause)
+
+    def resume(self):
+        self._paused = False
+        self.manager._loop.call_soon_threadsafe(self._apply_pause)
+
+    @property
+    def paused(self):
+        return self._paused
+
+    def set_speed(self, speed):
+        """
+        调节播放速度, 在下一个动作开始时生效
+        :param speed: 速度倍数, 大于 0
+        """
+        if speed <= 0:
+            raise ValueError("speed must be greater than 0")
+        self.speed = speed
+
+    def done(self):
+        return self.future.done()
+
+    def result(self, timeout=None):
+        """
+        等待播放结束
+        :return: PlaybackStats
+        """
+        return self.future.result(timeout)
+
+
+class PlaybackManager:
+    """
+    在后台事件循环中同时播放多个动作组
+
+    每个动作组只驱动声明的舵机(ActionSet 的 servos), 两个正在播放的动作组占用同一个舵机时拒绝播放.
+    播放的开始时刻对齐到 grid 的整数倍, 动作时间为 grid 整数倍的动作组的动作会在同一时刻到期,
+    同一时刻到期的动作合并为一次总线写入.
+
+        arm = action_set.play(ActionSet('wave.d6a', servos=(1, 2, 3)))
+        head = action_set.play(ActionSet('nod.d6a', servos=(17, 18)), speed=1.5)
+        head.pause()
+    """
+
+    def __init__(self, grid=0.01):
+        """
+        :param grid: 开始时刻对齐的间隔(秒)
+        """
+        self.grid = grid
+        self.bursts = 0  # 总线写入次数
+        self.keyframes = 0  # 写入的动作数
+        self._loop = None
+        self._claims = {}  # {舵机id: PlaybackHandle}
+        self._lock = threading.Lock()
+        self._pending = None  # 本轮事件循环中待合并写入的帧
+        self._written = None
+
+    def play(self, action_set, speed=1.0):
+        """
+        开始播放
+        :param action_set: ActionSet
+        :param speed: 速度倍数
+        :return: PlaybackHandle
+        """
+        if speed <= 0:
+            raise ValueError("speed must be greater than 0")
+        servos = action_set.servo_ids()
+        self._loop = _get_loop()
+        handle = PlaybackHandle(self, action_set, servos, speed)
+        with self._lock:
+            conflicts = sorted(id_ for id_ in servos if id_ in self._claims)
+            if conflicts:
+                raise ValueError("servos %s are used by another running action set" % conflicts)
+            for id_ in servos:
+                self._claims[id_] = handle
+            handle.future = asyncio.run_coroutine_threadsafe(self._run(handle), self._loop)
+        handle.future.add_done_callback(lambda f: self._release(handle))
+        return handle
+
+    def _release(self, handle):
+        with self._lock:
+            for id_ in handle.servos:
+                if self._claims.get(id_) is handle:
+                    del self._claims[id_]
+
+    def running(self):
+        """
+        :return: 正在播放的 PlaybackHandle 的列表
+        """
+        with self._lock:
+            return list({id(h): h for h in self._claims.values()}.values())
+
+    def cancel_all(self):
+        for handle in self.running():
+            handle.cancel()
+
+    async def _run(self, handle):
+        loop = asyncio.get_running_loop()
+        action_set = handle.action_set
+        handle._running = asyncio.Event()
+        handle._apply_pause()
+        compiled = None
+        if not action_set.stream:
+            compiled = await loop.run_in_executor(None, action_set.compile, handle.speed)
+        start = -(-loop.time() // self.grid) * self.grid
+        await _sleep_until(loop, start)
+        return await _play(action_set, compiled, handle, self._emit, start)
+
+    async def _emit(self, frames):
+        # 同一轮事件循环中提交的帧在下一轮合并为一次写入
+        loop = asyncio.get_running_loop()
+        if self._pending is None:
+            self._pending = []
+            self._written = loop.create_future()
+            loop.call_soon(lambda: loop.create_task(self._flush()))
+        self._pending.append(bytes(frames))
+        await asyncio.shield(self._written)
+
+    async def _flush(self):
+        pending, written = self._pending, self._written
+        self._pending = self._written = None
+        try:
+            await write_frames(b''.join(pending))
+        except Exception as e:
+            written.set_exception(e)
+        else:
+            written.set_result(None)
+        self.bursts += 1
+        self.keyframes += len(pending)
+
+    def stats(self):
+        """
+        :return: {running, bursts, keyframes}
+        """
+        return dict(running=len(self.running()), bursts=self.bursts, keyframes=self.keyframes)
+
+
+manager = PlaybackManager()
+
+
+def play(action_set, speed=1.0):
+    """
+    在后台与其它动作组同时播放, 见 PlaybackManager
+    :return: PlaybackHandle
+    """
+    return manager.play(action_set, speed)
+
+
 def _start_loop(loop_):
     asyncio.set_event_loop(loop_)
     loop_.run_forever()
 
 
-_loop = asyncio.get_event_loop()
-threading.Thread(target=_start_loop, args=(_loop,), daemon=True).start()
+def _get_loop():
+    """
+    后台事件循环, 首次以非阻塞方式运行动作组时启动
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=_start_loop, args=(loop,), daemon=True).start()
+            _loop = loop
+    return _loop
+
+
+_loop = None
+_loop_lock = threading.Lock()
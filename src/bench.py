@@ -0,0 +1,489 @@
+# This file is part of rsp_robot_hat_v3.
+# Copyright (C) 2021 Hiwonder Ltd. <support@hiwonder.com>
+#
+# rsp_robot_hat_v3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rsp_robot_hat_v3 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# title           :bench.py
+# author          :Hiwonder, LuYongping(Lucas)
+# date            :20261018
+# notes           :python3 -m hw_rsp_hat_v3.bench <name> [args]
+# ==============================================================================
+
+import sys
+import math
+import time
+import random
+
+
+def _legacy_frame(id_, cmd, params=None):
+    # 原 write_cmd 中基于列表的组帧方式, 作为对照
+    params_buf = []
+    if isinstance(params, list):
+        for p in params:
+            params_buf.extend([p % 256, p // 256 % 256])
+    else:
+        if isinstance(params, int) and 0 <= params < 256:
+            params_buf.append(params)
+    buf = [0x55, 0x55, id_, len(params_buf) + 3, cmd]
+    buf.extend(params_buf)
+    buf.append(255 - (sum(buf[2:]) % 256))
+    return bytes(buf)
+
+
+def _best_rate(func, count, repeat=5):
+    # 取多次测量中的最好成绩, 减小调度抖动的影响
+    best = float('inf')
+    for _ in range(repeat):
+        t = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - t)
+    return count / best
+
+
+def bench_frame_encoder(args):
+    """
+    对比原组帧方式与 FrameEncoder 的 帧/秒, 并校验两者输出逐字节一致
+    """
+    from ._serial_servo_frame import FrameEncoder
+    rounds = int(args[1]) if len(args) > 1 else 2000
+    encoder = FrameEncoder()
+    rnd = random.Random(0)
+    cmds = [(rnd.randint(0, 254), 1, [rnd.randint(-2000, 70000), rnd.randint(0, 30000)]) for _ in range(200)]
+    cmds += [(rnd.randint(0, 254), rnd.choice((13, 17, 31)), rnd.randint(0, 255)) for _ in range(50)]
+    cmds += [(rnd.randint(0, 254), rnd.choice((11, 12, 18)), None) for _ in range(50)]
+    cmds += [(rnd.randint(0, 254), rnd.choice((20, 22)), [rnd.randint(0, 1000), rnd.randint(0, 12000)])
+             for _ in range(50)]
+
+    for c in cmds:
+        if encoder.frame(*c) != _legacy_frame(*c):
+            raise AssertionError("frame mismatch: %r" % (c,))
+    pose = [(id_, 1, [500, 20]) for id_ in range(1, 19)]
+    if encoder.encode_burst(pose).tobytes() != b''.join(_legacy_frame(*c) for c in pose):
+        raise AssertionError("burst mismatch")
+    print("byte-identical: %d frames, 1 burst" % len(cmds))
+
+    def legacy_frames():
+        for _ in range(rounds // 10 or 1):
+            for c in cmds:
+                _legacy_frame(*c)
+
+    def encoder_frames():
+        for _ in range(rounds // 10 or 1):
+            for c in cmds:
+                encoder.encode(*c)
+
+    def legacy_bursts():
+        for _ in range(rounds):
+            b''.join([_legacy_frame(*c) for c in pose])
+
+    def encoder_bursts():
+        for _ in range(rounds):
+            encoder.encode_burst(pose)
+
+    count = (rounds // 10 or 1) * len(cmds)
+    legacy, encoded = _best_rate(legacy_frames, count), _best_rate(encoder_frames, count)
+    print("mixed commands")
+    print("legacy   : %10.0f frames/s" % legacy)
+    print("encoder  : %10.0f frames/s  (x%.2f)" % (encoded, encoded / legacy))
+    count = rounds * len(pose)
+    legacy, encoded = _best_rate(legacy_bursts, count), _best_rate(encoder_bursts, count)
+    print("18-servo pose burst")
+    print("legacy   : %10.0f frames/s" % legacy)
+    print("encoder  : %10.0f frames/s  (x%.2f)" % (encoded, encoded / legacy))
+
+
+def _percentile(sorted_values, p):
+    if not sorted_values:
+        return float('nan')
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100.0))]
+
+
+def _make_action_group(path, frames, servos, duration):
+    import sqlite3 as sql
+    columns = ', '.join('Servo%d INT' % i for i in range(1, servos + 1))
+    with sql.connect(path) as ag:
+        ag.execute("create table ActionGroup([Index] INTEGER PRIMARY KEY AUTOINCREMENT, Time INT, %s)" % columns)
+        ag.executemany("insert into ActionGroup values (null, ?%s)" % (', ?' * servos),
+                       [[duration] + [500 + (i % 2) * 100] * servos for i in range(frames)])
+
+
+def bench_bus(args):
+    """
+    在虚拟总线上测量写入速率、读取往返时间与重试次数以及动作组播放的时间误差
+    参数: [舵机数量=16] [每项测量时间(秒)=2] [丢帧率=0] [错帧率=0]
+    """
+    import os
+    import tempfile
+    from .servo_emulator import VirtualServoBus
+    from . import serial_servo, action_set
+    servos = int(args[1]) if len(args) > 1 else 16
+    seconds = float(args[2]) if len(args) > 2 else 2.0
+    drop_rate = float(args[3]) if len(args) > 3 else 0.0
+    corrupt_rate = float(args[4]) if len(args) > 4 else 0.0
+    ids = list(range(1, servos + 1))
+
+    with VirtualServoBus(ids, drop_rate=drop_rate, corrupt_rate=corrupt_rate, seed=0) as bus:
+        handle = bus.attach()
+        print("virtual bus: %d servos on %s, drop %.3f, corrupt %.3f" % (servos, bus.port, drop_rate, corrupt_rate))
+
+        count, t = 0, time.perf_counter()
+        while time.perf_counter() - t < seconds:
+            serial_servo.set_position(ids[count % servos], 500, 20)
+            count += 1
+        print("set_position  : %10.0f writes/s" % (count / (time.perf_counter() - t)))
+
+        pose = {id_: (500, 20) for id_ in ids}
+        count, t = 0, time.perf_counter()
+        while time.perf_counter() - t < seconds:
+            serial_servo.set_positions(pose)
+            count += 1
+        elapsed = time.perf_counter() - t
+        print("set_positions : %10.0f poses/s  %10.0f writes/s" % (count / elapsed, count * servos / elapsed))
+
+        handle.flush()
+        rtts, failures, t = [], 0, time.perf_counter()
+        while time.perf_counter() - t < seconds:
+            t0 = time.perf_counter()
+            if serial_servo.get_position(ids[len(rtts) % servos], retry=5) is None:
+                failures += 1
+            else:
+                rtts.append(time.perf_counter() - t0)
+        rtts.sort()
+        print("get_position  : %10d reads  p50 %.3f ms  p99 %.3f ms  max %.3f ms"
+              % (len(rtts), _percentile(rtts, 50) * 1000, _percentile(rtts, 99) * 1000, rtts[-1] * 1000 if rtts else 0))
+        bus_stats = serial_servo.stats()
+        reads = bus_stats['commands']['POS_READ']
+        print("                %10d retries  %d failures  %d checksum errors  lock wait p99 %.3f ms"
+              % (reads['retries'], reads['failures'], bus_stats['checksum_errors'],
+                 bus_stats['lock_wait']['p99'] * 1000))
+
+        frames, duration = int(seconds * 1000 / 20), 20
+        path = os.path.join(tempfile.mkdtemp(), 'bench.d6a')
+        _make_action_group(path, frames, servos, duration)
+        stats = action_set.run_action_set(action_set.ActionSet(path), block=True)
+        lateness = sorted(stats.lateness)
+        print("action_set    : %10d frames  %.3f s (expected %.3f s, late %.1f ms)"
+              % (stats.frames, stats.elapsed, stats.expected, (stats.elapsed - stats.expected) * 1000))
+        print("                lateness p50 %.3f ms  p99 %.3f ms  max %.3f ms  skipped %d"
+              % (_percentile(lateness, 50) * 1000, _percentile(lateness, 99) * 1000, stats.max_drift * 1000,
+                 stats.skipped))
+        print("emulator      : %r" % bus.stats())
+
+
+def bench_move_queue(args):
+    """
+    在虚拟总线上对比直接写入与经 move_queue 合并发送时规划器每秒可提交的目标数,
+    并校验 stop/unload 会作废排队中尚未发出的转动指令
+    参数: [舵机数量=8] [每项测量时间(秒)=2]
+    """
+    from .servo_emulator import VirtualServoBus
+    from . import serial_servo
+    servos = int(args[1]) if len(args) > 1 else 8
+    seconds = float(args[2]) if len(args) > 2 else 2.0
+    ids = list(range(1, servos + 1))
+    queue = serial_servo.move_queue
+
+    with VirtualServoBus(ids) as bus:
+        bus.attach()
+        for name in ("direct", "move_queue"):
+            if name == "move_queue":
+                queue.start()
+            count, t = 0, time.perf_counter()
+            while time.perf_counter() - t < seconds:
+                serial_servo.set_position(ids[count % servos], 300 + count % 400, 20)
+                count += 1
+            elapsed = time.perf_counter() - t
+            queue.stop()
+            print("%-10s: %10.0f targets/s" % (name, count / elapsed))
+        print("move_queue: %r" % queue.stats())
+
+        # 后台线程刚发出一次突发后要等待 period 才会再发, 其间的转动指令留在队列中
+        queue.period = 1.0
+        for preempt, check in ((serial_servo.stop, lambda servo: servo.position() == 500),
+                               (serial_servo.unload, lambda servo: servo.load_state == 0)):
+            serial_servo.set_position(1, 500, 0)
+            queue.start()
+            serial_servo.set_position(2, 500, 0)
+            time.sleep(0.05)
+            cancelled = queue.cancelled
+            serial_servo.set_position(1, 900, 0)
+            preempt(1)
+            queue.stop()
+            time.sleep(0.05)
+            if not check(bus.servos[1]) or queue.cancelled != cancelled + 1:
+                raise AssertionError("queued move sent after %s()" % preempt.__name__)
+        queue.period = 0.01
+        print("stop/unload cancel queued moves: ok")
+
+
+def bench_action_compile(args):
+    """
+    对比逐帧组装指令与播放编译后的动作组时每个动作的耗时, 并校验两者输出逐字节一致
+    参数: [舵机数量=16] [动作数量=1000]
+    """
+    import os
+    import tempfile
+    from . import serial_servo
+    from .action_set import ActionSet
+    from ._serial_servo_frame import FrameEncoder
+    servos = int(args[1]) if len(args) > 1 else 16
+    frames = int(args[2]) if len(args) > 2 else 1000
+    path = os.path.join(tempfile.mkdtemp(), 'bench.d6a')
+    _make_action_group(path, frames, servos, 20)
+    action_set = ActionSet(path, lock_servos={1: 500})
+    sink = os.open(os.devnull, os.O_WRONLY)
+    encoder = FrameEncoder()
+
+    def per_call():
+        # 原播放流程: 每个动作替换 lock 的舵机, 转换为指令列表后组帧写入
+        for act in action_set.load():
+            pos_set = list(act[2:])
+            for id_, lock_pos in action_set.lock_servos.items():
+                pos_set[id_ - 1] = lock_pos
+            os.write(sink, encoder.encode_burst(serial_servo._move_cmds(
+                [(id_, pos, act[1]) for id_, pos in enumerate(pos_set, 1)])))
+
+    def compiled():
+        for duration, data in action_set.compile():
+            os.write(sink, data)
+
+    t = time.thread_time()
+    action_set.compile()
+    compile_time = time.thread_time() - t
+    expected = bytearray()
+    for act in action_set.load():
+        pos_set = [500] + list(act[3:])
+        expected += encoder.encode_burst(serial_servo._move_cmds([(i, p, act[1]) for i, p in enumerate(pos_set, 1)]))
+    assert bytes(expected) == action_set.compile().frames
+
+    per_call_rate = _best_rate(per_call, frames)
+    compiled_rate = _best_rate(compiled, frames)
+    os.close(sink)
+    print("%d servos, %d frames, compile %.2f ms" % (servos, frames, compile_time * 1000))
+    print("per call : %8.2f us/frame" % (1e6 / per_call_rate))
+    print("compiled : %8.2f us/frame  (%.1fx)" % (1e6 / compiled_rate, compiled_rate / per_call_rate))
+
+
+def bench_pid(args):
+    """
+    对比 N 个 PID.update 与一次 PIDBank.update 的耗时, 并校验两者结果完全一致
+    参数: [最大控制器数量=256] [每项更新次数=200]
+    """
+    from . import pid
+    max_n = int(args[1]) if len(args) > 1 else 256
+    steps = int(args[2]) if len(args) > 2 else 200
+    rnd = random.Random(0)
+    times = [0.005 * (k + 1) for k in range(steps)]  # 200Hz
+
+    def make(n, sample_times):
+        pids = []
+        for i in range(n):
+            p = pid.PID(rnd.uniform(0, 2), rnd.uniform(0, 1), rnd.uniform(0, 0.1), current_time=0.0)
+            p.SetPoint = rnd.uniform(-100, 100)
+            p.setSampleTime(rnd.choice(sample_times))
+            p.setWindup(rnd.uniform(1, 20))
+            pids.append(p)
+        feedback = [[rnd.uniform(-100, 100) for _ in range(n)] for _ in range(steps)]
+        return pids, pid.PIDBank.from_pids(pids), feedback
+
+    def scalar(pids, feedback):
+        for values, t in zip(feedback, times):
+            for p, value in zip(pids, values):
+                p.update(value, t)
+
+    def vector(bank, feedback):
+        for values, t in zip(feedback, times):
+            bank.update(values, t)
+
+    print("PIDBank backend: %s" % ('numpy' if pid._numpy() is not None else 'array'))
+    n = 1
+    while n <= max_n:
+        # 部分控制器按 sample_time 跳过更新, 校验每个控制器的输出与状态逐位相同
+        pids, bank, feedback = make(n, (0.0, 0.004, 0.01))
+        scalar(pids, feedback)
+        vector(bank, feedback)
+        for i, p in enumerate(pids):
+            for name in ('output', 'PTerm', 'ITerm', 'DTerm', 'last_error', 'last_time'):
+                assert getattr(p, name) == getattr(bank, name)[i], (n, i, name)
+
+        pids, bank, feedback = make(n, (0.0,))
+        scalar_rate = _best_rate(lambda: scalar(pids, feedback), steps)
+        vector_rate = _best_rate(lambda: vector(bank, feedback), steps)
+        print("N=%4d  PID.update %9.1f us/cycle  PIDBank.update %9.1f us/cycle  %6.1fx"
+              % (n, 1e6 / scalar_rate, 1e6 / vector_rate, vector_rate / scalar_rate))
+        n *= 2
+
+
+def bench_pid_sweep(args):
+    """
+    在被控对象模型上仿真网格中所有 (Kp, Ki, Kd) 组合的阶跃响应, 列出排名靠前的增益
+    参数: [被控对象 first|second|dead=dead] [每个增益的取值数=16] [进程数]
+    """
+    from . import pid_sim
+    plant = pid_sim.PLANTS[args[1] if len(args) > 1 else 'dead']()
+    count = int(args[2]) if len(args) > 2 else 16
+    workers = int(args[3]) if len(args) > 3 else None
+    gains = pid_sim.grid(pid_sim.linspace(0.1, 10.0, count), pid_sim.linspace(0.0, 20.0, count),
+                         pid_sim.linspace(0.0, 0.2, count))
+    t = time.perf_counter()
+    results = pid_sim.sweep(plant, gains, workers=workers)
+    elapsed = time.perf_counter() - t
+    print(pid_sim.report(results, plant=plant))
+    backend = 'numpy' if pid_sim.pid._numpy() is not None else 'scalar'
+    print("%.2f s, %.0f gain sets/s (%s)" % (elapsed, len(gains) / elapsed, backend))
+
+
+def bench_pwm(args):
+    """
+    在虚拟 pigpiod 上对比逐通道输出与批量输出的 通道更新/秒 以及同一 tick 内各通道的时间差,
+    并校验硬件 PWM 输出的占空比以及不支持硬件 PWM 的引脚保持软件 PWM
+    参数: [通道数量=8] [每项测量时间(秒)=2] [守护进程处理延时(毫秒)=0]
+    """
+    from .pigpio_emulator import VirtualPigpiod
+    from . import pwm_servo
+    channels = int(args[1]) if len(args) > 1 else 8
+    seconds = float(args[2]) if len(args) > 2 else 2.0
+    delay = float(args[3]) / 1000.0 if len(args) > 3 else 0.0
+    pins = list(range(channels))
+
+    with VirtualPigpiod(delay=delay) as daemon:
+        output = daemon.attach()
+        print("virtual pigpiod: %d channels on port %d, delay %.3f ms" % (channels, daemon.port, delay * 1000))
+
+        def per_call(updates):
+            for update in updates:
+                output.set_pulsewidths([update])
+
+        for name, write in (("per call", per_call), ("batched", output.set_pulsewidths)):
+            ticks, skews, t = 0, [], time.perf_counter()
+            while time.perf_counter() - t < seconds:
+                updates = [(pin, 1000 + (ticks + pin) % 1000) for pin in pins]
+                start = len(daemon.history)
+                write(updates)
+                ticks += 1
+                applied = daemon.history[start:]
+                if len(applied) == channels:
+                    skews.append(applied[-1][0] - applied[0][0])
+                else:
+                    del daemon.history[:]  # 记录已满, 清空后继续
+            elapsed = time.perf_counter() - t
+            skews.sort()
+            print("%-8s: %10.0f ticks/s  %10.0f updates/s  skew p50 %.1f us  p99 %.1f us  max %.1f us"
+                  % (name, ticks / elapsed, ticks * channels / elapsed, _percentile(skews, 50) * 1e6,
+                     _percentile(skews, 99) * 1e6, skews[-1] * 1e6 if skews else 0))
+        print("daemon  : %r" % daemon.stats())
+
+        del daemon.history[:], daemon.duty_cycles[:]
+        servo = pwm_servo.servo1
+        if not servo.set_frequency(333):
+            raise AssertionError("servo1 (gpio 12) did not switch to hardware PWM")
+        servo.set_position(1500)
+        duty = daemon.duty_cycles[-1][1:]
+        if duty != (12, 333, 499500):
+            raise AssertionError("unexpected hardware PWM output %r" % (duty,))
+        servo.set_frequency(None)
+        software = pwm_servo.PwmServo(5)
+        if software.set_frequency(333) or software.get_frequency() is not None:
+            raise AssertionError("gpio 5 has no hardware PWM but set_frequency() accepted it")
+        software.set_position(1200)
+        if daemon.history[-1][1:] != (5, 1200):
+            raise AssertionError("gpio 5 did not keep software PWM: %r" % (daemon.history[-1][1:],))
+        print("hardware: gpio %d at %d Hz duty %d/1000000, gpio 5 falls back to software PWM" % duty)
+
+
+def bench_control_loop(args):
+    """
+    对比手写的 time.sleep 循环与 ControlLoop 在相同计算负载下的实际频率、周期抖动和超时次数
+    参数: [频率=200] [运行时间(秒)=3] [控制器数量=8]
+    """
+    from . import pid
+    from .control_loop import ControlLoop
+    rate = float(args[1]) if len(args) > 1 else 200.0
+    seconds = float(args[2]) if len(args) > 2 else 3.0
+    n = int(args[3]) if len(args) > 3 else 8
+    period = 1.0 / rate
+    pids = [pid.PID(1.0, 0.5, 0.01) for _ in range(n)]
+
+    def sensor():
+        return sum(math.sin(k) for k in range(2000))  # 约几十微秒的计算
+
+    # 常见写法: 每次计算后固定睡眠一个周期, 使用 time.time()
+    count, starts, t = 0, [], time.time()
+    while time.time() - t < seconds:
+        now = time.time()
+        starts.append(now)
+        for p in pids:
+            p.update(sensor(), now)
+        count += 1
+        time.sleep(period)
+    gaps = [b - a for a, b in zip(starts, starts[1:])]
+    print("sleep loop : %7.1f Hz  period error avg %7.3f ms  max %7.3f ms" %
+          (count / seconds, (sum(gaps) / len(gaps) - period) * 1000, (max(gaps) - period) * 1000))
+
+    loop = ControlLoop(rate)
+    for p in pids:
+        loop.add(p, sensor)
+    loop.run(seconds)
+    s = loop.stats()
+    print("ControlLoop: %7.1f Hz  jitter avg %7.3f ms  max %7.3f ms  compute avg %.3f ms  overruns %d" %
+          (s['cycles'] / seconds, s['jitter_avg'] * 1000, s['jitter_max'] * 1000, s['compute_avg'] * 1000,
+           s['overruns']))
+
+
+_IMPORT_PROBE = """
+import sys, time, threading
+t = time.perf_counter()
+%s
+elapsed = time.perf_counter() - t
+hardware = [m for m in ('pigpio', 'RPi.GPIO') if m in sys.modules]
+print(elapsed, threading.active_count(), ','.join(hardware) or '-')
+"""
+
+
+def bench_import(args):
+    """
+    在新进程中测量导入耗时, 并检查导入后没有加载硬件库、没有启动线程
+    参数: [每项运行次数=5]
+    """
+    import subprocess
+    runs = int(args[1]) if len(args) > 1 else 5
+    statements = ("import hw_rsp_hat_v3",
+                  "from hw_rsp_hat_v3 import pid",
+                  "from hw_rsp_hat_v3 import misc",
+                  "from hw_rsp_hat_v3 import serial_servo",
+                  "from hw_rsp_hat_v3 import pwm_servo, buzzer",
+                  "from hw_rsp_hat_v3 import action_set")
+    for statement in statements:
+        best = float('inf')
+        for _ in range(runs):
+            out = subprocess.check_output([sys.executable, '-c', _IMPORT_PROBE % statement]).split()
+            best = min(best, float(out[0]))
+        print("%-45s %8.2f ms  threads %s  hardware libs %s" % (statement, best * 1000, int(out[1]), out[2].decode()))
+
+
+bench_list = dict(frame_encoder=bench_frame_encoder,
+                  bus=bench_bus,
+                  move_queue=bench_move_queue,
+                  action_compile=bench_action_compile,
+                  pid=bench_pid,
+                  pid_sweep=bench_pid_sweep,
+                  pwm=bench_pwm,
+                  control_loop=bench_control_loop,
+                  imports=bench_import)
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] in bench_list:
+        bench_list[sys.argv[1]](sys.argv[1:])
+    else:
+        print("usage: python3 -m hw_rsp_hat_v3.bench {%s} [args]" % ','.join(bench_list))
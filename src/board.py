@@ -0,0 +1,77 @@
+# This file is part of rsp_robot_hat_v3.
+# Copyright (C) 2021 Hiwonder Ltd. <support@hiwonder.com>
+#
+# rsp_robot_hat_v3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rsp_robot_hat_v3 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# title           :board.py
+# author          :Hiwonder, LuYongping(Lucas)
+# date            :20261018
+# notes           :
+# ==============================================================================
+
+from . import _pwm_output
+from . import _serial_servo_commands as _ssc
+from . import buzzer
+from . import pwm_servo
+from . import serial_servo
+
+
+class Board:
+    """
+    扩展板硬件
+
+    导入本包不会访问任何硬件, 串口、GPIO 与 pigpio 都在首次使用时自动打开.
+    需要在确定的时刻打开和释放硬件时使用 Board:
+
+        with hw_rsp_hat_v3.open() as board:
+            board.serial_servo.set_position(1, 500, 1000)
+    """
+    buzzer = buzzer
+    pwm_servo = pwm_servo
+    serial_servo = serial_servo
+
+    def __init__(self, serial_port=_ssc.SERIAL_PORT, baudrate=_ssc.BAUDRATE):
+        self.serial_port = serial_port
+        self.baudrate = baudrate
+
+    def open(self):
+        """
+        打开舵机串口, 初始化 GPIO 并连接 pigpio
+        :return: self
+        """
+        _ssc.port_open(self.serial_port, self.baudrate)
+        buzzer.set_state(0)
+        _pwm_output.output().connect()
+        return self
+
+    def close(self):
+        """
+        关闭舵机串口并断开 pigpio 连接
+        """
+        _ssc.port_close()
+        _pwm_output.close()
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def open(serial_port=_ssc.SERIAL_PORT, baudrate=_ssc.BAUDRATE):
+    """
+    打开扩展板硬件
+    :return: Board
+    """
+    return Board(serial_port, baudrate).open()
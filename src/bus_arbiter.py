@@ -0,0 +1,225 @@
+# This file is part of rsp_robot_hat_v3.
+# Copyright (C) 2021 Hiwonder Ltd. <support@hiwonder.com>
+#
+# rsp_robot_hat_v3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rsp_robot_hat_v3 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# title           :bus_arbiter.py
+# author          :Hiwonder, LuYongping(Lucas)
+# date            :20261018
+# notes           :
+# ==============================================================================
+
+import time
+import queue
+import itertools
+import threading
+from concurrent.futures import Future
+from . import _serial_servo_commands as _ssc
+
+# 优先级, 数值越小越优先
+EMERGENCY = 0
+MOTION = 1
+CONFIG = 2
+TELEMETRY = 3
+CLASS_NAMES = ('emergency', 'motion', 'config', 'telemetry')
+
+# 各优先级在队列中的最长等待时间(秒), 超时的指令不再发送: 写指令的调用者得到 DeadlineExceeded,
+# 读指令的该次尝试按无应答处理. None 表示不限
+DEFAULT_DEADLINES = {EMERGENCY: None, MOTION: 0.1, CONFIG: 2.0, TELEMETRY: 0.2}
+
+_COMMAND_CLASSES = {
+    _ssc.MOVE_STOP: EMERGENCY,
+    _ssc.LOAD_OR_UNLOAD_WRITE: EMERGENCY,
+    _ssc.MOVE_TIME_WRITE: MOTION,
+    _ssc.MOVE_TIME_WAIT_WRITE: MOTION,
+    _ssc.MOVE_START: MOTION,
+    _ssc.OR_MOTOR_MODE_WRITE: MOTION,
+    _ssc.POS_READ: TELEMETRY,
+    _ssc.TEMP_READ: TELEMETRY,
+    _ssc.VIN_READ: TELEMETRY,
+    _ssc.MOVE_TIME_READ: TELEMETRY,
+    _ssc.MOVE_TIME_WAIT_READ: TELEMETRY,
+}
+
+
+class DeadlineExceeded(TimeoutError):
+    """
+    指令在队列中等待超过所属优先级的期限, 没有发送
+    """
+
+
+def command_class(cmds):
+    """
+    一组指令的优先级, 取其中最高的一个, 未列出的指令为 CONFIG
+    :param cmds: 指令列表
+    :return:
+    """
+    return min((_COMMAND_CLASSES.get(cmd, CONFIG) for cmd in cmds), default=CONFIG)
+
+
+class _ClassStats:
+    __slots__ = ('depth', 'submitted', 'executed', 'expired', 'wait_total', 'wait_max')
+
+    def __init__(self):
+        self.depth = 0
+        self.submitted = 0
+        self.executed = 0
+        self.expired = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def as_dict(self):
+        d = {k: getattr(self, k) for k in self.__slots__}
+        d['wait_avg'] = self.wait_total / self.executed if self.executed else 0.0
+        return d
+
+
+class BusArbiter:
+    """
+    串口总线仲裁器
+
+    由一个总线线程独占串口, 按 EMERGENCY > MOTION > CONFIG > TELEMETRY 的优先级从队列中取出指令执行,
+    同优先级先进先出. 读指令的每次重试单独排队, 因此急停、掉电指令最多等待当前正在进行的一次收发.
+    """
+
+    def __init__(self, deadlines=None):
+        self.deadlines = dict(DEFAULT_DEADLINES)
+        if deadlines:
+            self.deadlines.update(deadlines)
+        self._queue = queue.PriorityQueue()
+        self._seq = itertools.count()
+        self._stats = [_ClassStats() for _ in CLASS_NAMES]
+        self._stats_lock = threading.Lock()  # 同时保护 _accepting, 使停止前提交的指令都排在停止标记之前
+        self._accepting = False
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._bus_task, daemon=True)
+        self._thread.start()
+        with self._stats_lock:
+            self._accepting = True
+
+    def stop(self):
+        if self._thread is None:
+            return
+        # 停止标记排在所有优先级之后, 已提交的指令执行完毕后线程才退出; 此后提交的指令在调用线程中直接执行
+        with self._stats_lock:
+            self._accepting = False
+            self._queue.put((len(CLASS_NAMES), next(self._seq), 0, None, None, None, False))
+        self._thread.join()
+        self._thread = None
+
+    def submit(self, cmds, func, *args, priority=None, expire_ok=False):
+        """
+        提交一次总线操作
+        :param cmds: 该操作涉及的指令, 用于确定优先级
+        :param func: 在总线线程中持有 _ssc.lock 时调用, 仲裁器未运行时在调用线程中持有 _ssc.lock 调用
+        :param priority: 指定优先级, 为空时由 cmds 决定
+        :param expire_ok: 超过期限时结果为 None(用于读指令的一次尝试), 否则为 DeadlineExceeded 异常
+        :return: concurrent.futures.Future
+        """
+        priority = command_class(cmds) if priority is None else priority
+        future = Future()
+        with self._stats_lock:
+            if self._accepting:
+                stats = self._stats[priority]
+                stats.depth += 1
+                stats.submitted += 1
+                self._queue.put((priority, next(self._seq), time.monotonic(), future, func, args, expire_ok))
+                return future
+        try:
+            with _ssc.lock:
+                future.set_result(func(*args))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+    def call(self, cmds, func, *args, priority=None, expire_ok=False):
+        """
+        提交一次总线操作并等待其完成
+        :return: func 的返回值, 等待超过期限被丢弃时为 None(expire_ok) 或抛出 DeadlineExceeded
+        """
+        if threading.current_thread() is self._thread:
+            return func(*args)  # 总线线程执行 func 时已持有 _ssc.lock
+        return self.submit(cmds, func, *args, priority=priority, expire_ok=expire_ok).result()
+
+    def _bus_task(self):
+        while True:
+            priority, _, enqueued, future, func, args, expire_ok = self._queue.get()
+            if future is None:
+                break
+            started = time.monotonic()
+            waited = started - enqueued
+            deadline = self.deadlines.get(priority)
+            expired = deadline is not None and waited > deadline
+            with self._stats_lock:
+                stats = self._stats[priority]
+                stats.depth -= 1
+                if expired:
+                    stats.expired += 1
+                else:
+                    stats.executed += 1
+                    stats.wait_total += waited
+                    stats.wait_max = max(stats.wait_max, waited)
+            if expired:
+                if expire_ok:
+                    future.set_result(None)
+                else:
+                    future.set_exception(DeadlineExceeded("%s operation waited %.3f s, deadline %.3f s"
+                                                          % (CLASS_NAMES[priority], waited, deadline)))
+                continue
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                with _ssc.lock:
+                    result = func(*args)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def stats(self):
+        """
+        :return: {优先级名: {depth, submitted, executed, expired, wait_total, wait_max, wait_avg}}
+        """
+        with self._stats_lock:
+            return {name: s.as_dict() for name, s in zip(CLASS_NAMES, self._stats)}
+
+
+def start(deadlines=None):
+    """
+    启用总线仲裁, 此后 _serial_servo_commands 的读写都经由总线线程按优先级执行
+    :param deadlines: {优先级: 最长等待时间(秒)}, 覆盖 DEFAULT_DEADLINES 中的对应项
+    :return: BusArbiter
+    """
+    if _ssc._arbiter is None:
+        arbiter = BusArbiter(deadlines)
+        arbiter.start()
+        _ssc._arbiter = arbiter
+    return _ssc._arbiter
+
+
+def stop():
+    """
+    停用总线仲裁, 恢复各调用线程直接加锁访问总线
+    """
+    arbiter, _ssc._arbiter = _ssc._arbiter, None
+    if arbiter is not None:
+        arbiter.stop()
+
+
+def stats():
+    return _ssc._arbiter.stats() if _ssc._arbiter is not None else {}
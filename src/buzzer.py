@@ -21,12 +21,21 @@
 # ==============================================================================
 
 
-from ._common import GPIO
+from . import _common
 
+_pin = 31
+GPIO = None
 
-def set_state(new_state):
-    GPIO.output(31, new_state)
+
+def _init():
+    global GPIO
+    gpio = _common.gpio()
+    gpio.setup(_pin, gpio.OUT)
+    gpio.output(_pin, 0)
+    GPIO = gpio
 
 
-GPIO.setup(31, GPIO.OUT)
-set_state(0)
+def set_state(new_state):
+    if GPIO is None:
+        _init()
+    GPIO.output(_pin, new_state)
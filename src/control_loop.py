@@ -0,0 +1,284 @@
+# This file is part of rsp_robot_hat_v3.
+# Copyright (C) 2021 Hiwonder Ltd. <support@hiwonder.com>
+#
+# rsp_robot_hat_v3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rsp_robot_hat_v3 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# title           :control_loop.py
+# author          :Hiwonder, LuYongping(Lucas)
+# date            :20261018
+# notes           :
+# ==============================================================================
+
+import math
+import time
+import threading
+from . import serial_servo
+from . import _pwm_output
+from .pwm_servo import PwmServo
+from .pid import PIDBank
+from .bus_arbiter import DeadlineExceeded
+
+# 周期超时(本周期结束时已过下一个计划时刻)的处理策略
+SKIP = 'skip'  # 放弃错过的周期, 从下一个未过期的计划时刻继续
+CATCH_UP = 'catch_up'  # 不等待, 连续执行错过的周期, 落后超过 MAX_BACKLOG 个周期时放弃多余的
+DEGRADE = 'degrade'  # 周期加倍(频率减半), 持续有余量后再逐级恢复
+POLICIES = (SKIP, CATCH_UP, DEGRADE)
+
+
+def _sync_clock(controller, t):
+    # PID 默认以 time.time() 计时, 改为从循环使用的 monotonic 时刻开始计时
+    if isinstance(controller, PIDBank):
+        controller.current_time[:] = controller._array(float(t))
+        controller.last_time[:] = controller.current_time
+    elif hasattr(controller, 'last_time'):
+        controller.current_time = controller.last_time = t
+
+
+class ControlLoop:
+    """
+    固定频率的控制循环
+
+    由一个后台线程按 time.monotonic() 上的绝对计划时刻执行所有注册的控制器, 睡眠误差和计算耗时不会累积.
+    每个周期依次调用各控制器的传感器回调、controller.update 和输出回调, 所有输出汇总后
+    串口舵机在一次总线写入中发出, PWM 舵机在一次 pigpiod 往返中输出.
+
+        pid = PID(0.5, 0.1, 0.01)
+        pid.SetPoint = 320
+        loop = ControlLoop(rate=100)
+        loop.add(pid, lambda: camera.target_x, lambda u: {1: 500 + u})
+        with loop:
+            time.sleep(10)
+        print(loop.stats())
+
+    控制器收到的 current_time 是本周期的计划时刻, 相邻两次 update 的间隔恒为周期的整数倍, 不受唤醒抖动影响;
+    开始运行时控制器的 last_time 会重置为第一个计划时刻.
+    """
+
+    MAX_BACKLOG = 10  # CATCH_UP 最多补执行的周期数
+    RECOVER_TIME = 1.0  # DEGRADE 降频后至少经过这段时间(秒)才尝试恢复
+
+    def __init__(self, rate=100, policy=SKIP, min_rate=None, duration=None):
+        """
+        :param rate: 频率(Hz)
+        :param policy: 周期超时的处理策略, 见 POLICIES
+        :param min_rate: DEGRADE 策略可降到的最低频率, 默认为 rate 的 1/8
+        :param duration: 串口舵机转动指令的时间(毫秒), 默认为当前周期, 舵机在下一周期到来前匀速转到新位置
+        """
+        if rate <= 0:
+            raise ValueError("rate must be greater than 0")
+        if policy not in POLICIES:
+            raise ValueError("unknown policy %r" % (policy,))
+        self.period = 1.0 / rate
+        self.max_period = 1.0 / min_rate if min_rate else self.period * 8
+        if self.max_period < self.period:
+            raise ValueError("min_rate must not be greater than rate")
+        self.policy = policy
+        self.duration = duration
+        self.error = None  # 使循环停止的异常
+        self._period = self.period  # 当前周期, DEGRADE 时可能大于 period
+        self._controllers = []
+        self._stop = threading.Event()
+        self._thread = None
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self.cycles = 0
+        self.overruns = 0  # 结束时已过下一个计划时刻的周期数
+        self.skipped = 0  # 放弃的计划时刻数
+        self.degrades = 0
+        self.sensor_failures = 0  # 传感器回调返回 None 的次数
+        self.expired = 0  # 串口舵机输出在总线仲裁器中等待超过期限而没有发出的周期数, 下一周期照常输出
+        self.compute_total = 0.0
+        self.compute_max = 0.0
+        self.jitter_total = 0.0  # 各周期开始时刻晚于计划时刻的时间之和
+        self.jitter_squares = 0.0
+        self.jitter_max = 0.0
+
+    @property
+    def rate(self):
+        """
+        当前频率, DEGRADE 策略降频时低于设定频率
+        """
+        return 1.0 / self._period
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def add(self, controller, sensor, output=None):
+        """
+        注册控制器, 运行中也可以添加
+        :param controller: pid.PID, pid.PIDBank 或提供 update(feedback, current_time) 和 output 的对象
+        :param sensor: 无参数的回调, 返回 controller.update 的反馈值, 返回 None 时本周期不更新该控制器
+        :param output: 以 controller.output 调用的回调, 返回 {舵机: 位置} 或 (舵机, 位置) 的可迭代对象,
+                       舵机为串口舵机id 或 PwmServo, 返回 None 时不输出
+        :return: controller
+        """
+        if self.running:
+            _sync_clock(controller, time.monotonic())
+        self._controllers = self._controllers + [(controller, sensor, output)]
+        return controller
+
+    def remove(self, controller):
+        self._controllers = [c for c in self._controllers if c[0] is not controller]
+
+    def start(self):
+        """
+        清空统计并开始运行
+        """
+        if self.running:
+            return
+        self._reset_stats()
+        self.error = None
+        self._period = self.period
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop_task, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        停止运行, 循环因回调异常停止时重新抛出该异常
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def run(self, seconds):
+        """
+        阻塞运行指定时间
+        :param seconds:
+        :return: self
+        """
+        self.start()
+        self._stop.wait(seconds)
+        self.stop()
+        return self
+
+    def step(self, current_time):
+        """
+        执行一个周期: 读取传感器、更新控制器并一起输出
+        :param current_time: 传给 controller.update 的时刻
+        """
+        duration = self.duration if self.duration is not None else int(round(self._period * 1000))
+        positions = {}
+        pwm = {}
+        for controller, sensor, output in self._controllers:
+            feedback = sensor()
+            if feedback is None:
+                self.sensor_failures += 1
+                continue
+            controller.update(feedback, current_time)
+            if output is None:
+                continue
+            writes = output(controller.output)
+            if writes is None:
+                continue
+            for servo, position in (writes.items() if isinstance(writes, dict) else writes):
+                if isinstance(servo, PwmServo):
+                    pwm[servo] = position
+                else:
+                    positions[servo] = (int(round(position)), duration)
+        if positions:
+            try:
+                serial_servo.set_positions(positions)
+            except DeadlineExceeded:
+                self.expired += 1
+        if pwm:
+            updates = []
+            for servo, position in pwm.items():
+                low, high = servo.limits()
+                position = int(round(min(max(position, low), high)))
+                with servo.lock:
+                    updates.append(servo._hold(position))
+            _pwm_output.output().set_pulsewidths(updates)
+
+    def _loop_task(self):
+        try:
+            self._run()
+        except BaseException as e:
+            self.error = e
+
+    def _run(self):
+        deadline = time.monotonic()
+        for controller, _, _ in self._controllers:
+            _sync_clock(controller, deadline)
+        window_start, window_max = deadline, 0.0  # DEGRADE 恢复的观察窗口
+        while not self._stop.is_set():
+            start = time.monotonic()
+            jitter = start - deadline
+            self.jitter_total += jitter
+            self.jitter_squares += jitter * jitter
+            self.jitter_max = max(self.jitter_max, jitter)
+
+            t = time.perf_counter()
+            self.step(deadline)
+            compute = time.perf_counter() - t
+            self.cycles += 1
+            self.compute_total += compute
+            self.compute_max = max(self.compute_max, compute)
+            window_max = max(window_max, compute)
+
+            deadline += self._period
+            now = time.monotonic()
+            if now > deadline:
+                self.overruns += 1
+                behind = int((now - deadline) // self._period) + 1  # 已过期的计划时刻数
+                if self.policy == SKIP:
+                    deadline += behind * self._period
+                    self.skipped += behind
+                elif self.policy == CATCH_UP:
+                    if behind > self.MAX_BACKLOG:
+                        deadline += (behind - self.MAX_BACKLOG) * self._period
+                        self.skipped += behind - self.MAX_BACKLOG
+                else:
+                    if self._period < self.max_period:
+                        self._period = min(self._period * 2, self.max_period)
+                        self.degrades += 1
+                    deadline = now + self._period
+                    window_start, window_max = now, 0.0
+            elif self._period > self.period and now - window_start >= self.RECOVER_TIME:
+                # 观察窗口内最长的计算也只占恢复后周期的一半以内时, 频率加倍
+                faster = max(self._period / 2, self.period)
+                if window_max < faster / 2:
+                    deadline += faster - self._period
+                    self._period = faster
+                window_start, window_max = now, 0.0
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                self._stop.wait(delay)
+
+    def stats(self):
+        """
+        :return: {rate, target_rate, policy, cycles, overruns, skipped, degrades, sensor_failures, expired,
+                  compute_avg, compute_max, jitter_avg, jitter_std, jitter_max}, 时间单位为秒
+        """
+        cycles = self.cycles
+        jitter_avg = self.jitter_total / cycles if cycles else 0.0
+        jitter_var = self.jitter_squares / cycles - jitter_avg * jitter_avg if cycles else 0.0
+        return dict(rate=self.rate, target_rate=1.0 / self.period, policy=self.policy, cycles=cycles,
+                    overruns=self.overruns, skipped=self.skipped, degrades=self.degrades,
+                    sensor_failures=self.sensor_failures, expired=self.expired,
+                    compute_avg=self.compute_total / cycles if cycles else 0.0, compute_max=self.compute_max,
+                    jitter_avg=jitter_avg, jitter_std=math.sqrt(max(jitter_var, 0.0)), jitter_max=self.jitter_max)
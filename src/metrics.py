@@ -0,0 +1,294 @@
+# This file is part of rsp_robot_hat_v3.
+# Copyright (C) 2021 Hiwonder Ltd. <support@hiwonder.com>
+#
+# rsp_robot_hat_v3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rsp_robot_hat_v3 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# title           :metrics.py
+# author          :Hiwonder, LuYongping(Lucas)
+# date            :20261018
+# notes           :
+# ==============================================================================
+
+import bisect
+import threading
+
+PREFIX = 'hiwonder'
+DEFAULT_PORT = 9120
+LATENCY_BUCKETS = (0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)  # 秒
+
+registry = []  # 所有 BusMetrics, 由导出器依次输出
+
+
+class Histogram:
+    """
+    固定分桶的直方图, observe 只做一次二分查找和几次加法
+    """
+
+    __slots__ = ('bounds', 'counts', 'count', 'total', 'max')
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # 最后一个桶为 +Inf
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """
+        :return: 第 q 分位数所在桶的上界, 落在 +Inf 桶时为最大值
+        """
+        if not self.count:
+            return 0.0
+        rank, cumulative = q * self.count, 0
+        for bound, n in zip(self.bounds, self.counts):
+            cumulative += n
+            if cumulative >= rank:
+                return bound
+        return self.max
+
+    def as_dict(self):
+        return dict(count=self.count, sum=self.total, avg=self.total / self.count if self.count else 0.0,
+                    max=self.max, p50=self.quantile(0.5), p90=self.quantile(0.9), p99=self.quantile(0.99))
+
+
+class _CommandStats:
+    __slots__ = ('calls', 'retries', 'failures', 'latency')
+
+    def __init__(self):
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+        self.latency = Histogram()
+
+    def as_dict(self):
+        return dict(calls=self.calls, retries=self.retries, failures=self.failures, latency=self.latency.as_dict())
+
+
+class _ServoStats:
+    __slots__ = ('calls', 'retries', 'failures', 'checksum_errors')
+
+    def __init__(self):
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+        self.checksum_errors = 0
+
+    def as_dict(self):
+        return {k: getattr(self, k) for k in self.__slots__}
+
+
+class BusMetrics:
+    """
+    一条总线的计数器与延时直方图
+
+    record() 在调用方线程中记录一次完整的操作(含排队、等锁与重试), 由自身的 lock 保护;
+    bytes_in、bytes_out、checksum_errors 与 count_checksum_errors() 在实际收发处更新, 由总线自己的锁保护.
+    每次操作的开销约为一次无竞争的加锁和几次字典查找, 相对一次串口收发可以忽略, 可以一直开启.
+    """
+
+    def __init__(self, name, command_names=None, servo_label='servo'):
+        """
+        :param name: 总线名称, 用作导出指标名的一部分
+        :param command_names: {指令: 名称}, 导出时用名称作为 command 标签
+        :param servo_label: 导出时舵机编号的标签名
+        """
+        self.name = name
+        self.command_names = command_names or {}
+        self.servo_label = servo_label
+        self.enabled = True
+        self.lock = threading.Lock()
+        self.reset()
+        registry.append(self)
+
+    def reset(self):
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.checksum_errors = 0
+        self.lock_wait = Histogram()
+        self._commands = {}
+        self._servos = {}
+
+    def _servo(self, id_):
+        servo = self._servos.get(id_)
+        if servo is None:
+            servo = self._servos.setdefault(id_, _ServoStats())
+        return servo
+
+    def record(self, cmd, latency, ids=(), lock_wait=None, retries=0, failed=False, failed_ids=None):
+        """
+        记录一次操作
+        :param cmd: 指令或操作名
+        :param latency: 从调用到完成的时间(秒)
+        :param ids: 涉及的舵机
+        :param lock_wait: 等待总线锁的时间(秒), 经 bus_arbiter 排队时为 None
+        :param retries: 重试次数
+        :param failed: 是否最终失败
+        :param failed_ids: 一次操作涉及多个舵机时只有其中部分失败的舵机, 为 None 时按 failed 计
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            command = self._commands.get(cmd)
+            if command is None:
+                command = self._commands[cmd] = _CommandStats()
+            command.calls += 1
+            command.retries += retries
+            command.failures += failed
+            command.latency.observe(latency)
+            if lock_wait is not None:
+                self.lock_wait.observe(lock_wait)
+            for id_ in ids:
+                servo = self._servo(id_)
+                servo.calls += 1
+                servo.retries += retries
+                servo.failures += failed if failed_ids is None else id_ in failed_ids
+
+    def count_checksum_errors(self, id_, count):
+        # 需在持有总线锁时调用
+        self.checksum_errors += count
+        self._servo(id_).checksum_errors += count
+
+    def _command_name(self, cmd):
+        return str(self.command_names.get(cmd, cmd))
+
+    def stats(self):
+        """
+        :return: {bytes_in, bytes_out, checksum_errors, lock_wait, commands: {指令名: ...}, servos: {id: ...}},
+                 时间单位为秒
+        """
+        with self.lock:
+            return dict(bytes_in=self.bytes_in, bytes_out=self.bytes_out, checksum_errors=self.checksum_errors,
+                        lock_wait=self.lock_wait.as_dict(),
+                        commands={self._command_name(k): c.as_dict() for k, c in self._commands.items()},
+                        servos={k: s.as_dict() for k, s in sorted(self._servos.items())})
+
+    def prometheus(self):
+        """
+        :return: Prometheus 文本格式的指标
+        """
+        p = '%s_%s' % (PREFIX, self.name)
+        lines = []
+
+        def metric(name, kind, samples):
+            lines.append('# TYPE %s_%s %s' % (p, name, kind))
+            for labels, value in samples:
+                lines.append('%s_%s%s %s' % (p, name, labels, _number(value)))
+
+        def histogram(name, items):
+            lines.append('# TYPE %s_%s histogram' % (p, name))
+            for labels, h in items:
+                cumulative = 0
+                for bound, n in zip(h.bounds + (float('inf'),), h.counts):
+                    cumulative += n
+                    lines.append('%s_%s_bucket%s %d' % (p, name, _labels(labels, le=_number(bound)), cumulative))
+                lines.append('%s_%s_sum%s %s' % (p, name, _labels(labels), _number(h.total)))
+                lines.append('%s_%s_count%s %d' % (p, name, _labels(labels), h.count))
+
+        with self.lock:
+            commands = [(dict(command=self._command_name(k)), c) for k, c in self._commands.items()]
+            servos = [({self.servo_label: str(k)}, s) for k, s in sorted(self._servos.items())]
+            metric('bytes_in_total', 'counter', [('', self.bytes_in)])
+            metric('bytes_out_total', 'counter', [('', self.bytes_out)])
+            metric('checksum_errors_total', 'counter', [('', self.checksum_errors)])
+            histogram('lock_wait_seconds', [({}, self.lock_wait)])
+            for field in ('calls', 'retries', 'failures'):
+                metric('command_%s_total' % field, 'counter',
+                       [(_labels(labels), getattr(c, field)) for labels, c in commands])
+            histogram('command_latency_seconds', [(labels, c.latency) for labels, c in commands])
+            for field in _ServoStats.__slots__:
+                metric('%s_%s_total' % (self.servo_label, field), 'counter',
+                       [(_labels(labels), getattr(s, field)) for labels, s in servos])
+        return '\n'.join(lines) + '\n'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _labels(labels, **extra):
+    labels = dict(labels, **extra)
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                             for k, v in labels.items())
+
+
+def stats():
+    """
+    :return: {总线名称: BusMetrics.stats()}
+    """
+    return {m.name: m.stats() for m in registry}
+
+
+def prometheus():
+    """
+    :return: 所有总线的 Prometheus 文本格式指标
+    """
+    return ''.join(m.prometheus() for m in registry)
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def start_exporter(port=DEFAULT_PORT, host='127.0.0.1'):
+    """
+    在后台线程中启动 HTTP 服务, GET /metrics 返回 Prometheus 文本格式的指标
+    :param port: 端口, 为 0 时由系统分配
+    :param host: 监听地址, 默认只允许本机访问
+    :return: (host, port)
+    """
+    global _server
+    with _server_lock:
+        if _server is None:
+            from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path.split('?')[0] != '/metrics':
+                        self.send_error(404)
+                        return
+                    body = prometheus().encode()
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, *args):
+                    pass
+
+            server = ThreadingHTTPServer((host, port), Handler)
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            _server = server
+        return _server.server_address[:2]
+
+
+def stop_exporter():
+    global _server
+    with _server_lock:
+        server, _server = _server, None
+    if server is not None:
+        server.shutdown()
+        server.server_close()
@@ -29,6 +29,26 @@
 More information about PID Controller: http://en.wikipedia.org/wiki/PID_controller
 """
 import time
+from array import array
+
+np = None  # 第一次需要时才导入, 只用 PID 的程序不必付出导入 numpy 的时间; trajectory 也经由 _numpy() 导入
+_numpy_checked = False
+
+
+def _numpy():
+    """
+    :return: numpy 模块, 未安装时为 None
+    """
+    global np, _numpy_checked
+    if not _numpy_checked:
+        try:
+            import numpy
+            np = numpy
+        except ImportError:
+            pass
+        _numpy_checked = True
+    return np
+
 
 class PID:
     """PID Controller
@@ -127,3 +147,167 @@ class PID:
         Based on a pre-determined sampe time, the PID decides if it should compute or return immediately.
         """
         self.sample_time = sample_time
+
+
+class PIDBank:
+    """A bank of N PID Controllers updated together
+
+    Gains, terms and timestamps of all controllers are kept in contiguous arrays
+    (numpy arrays if numpy is installed, array('d') otherwise) and can be read or
+    assigned per controller, e.g. ``bank.Kp[3] = 1.2``, ``bank.SetPoint[:] = targets``.
+    update() gives exactly the same results as calling PID.update on N separate controllers.
+
+    A bank only pays off for large N: each update() has a fixed cost of a few microseconds,
+    so with numpy it breaks even at about 32 controllers and is ~3.5x faster at 256
+    (``python3 -m hw_rsp_hat_v3.bench pid``). For a few dozen loops or fewer, separate PID
+    objects are as fast or faster. Without numpy the array backend is always slower than PID.
+    """
+
+    _FIELDS = ('Kp', 'Ki', 'Kd', 'sample_time', 'windup_guard', 'SetPoint',
+               'PTerm', 'ITerm', 'DTerm', 'last_error', 'int_error', 'output', 'current_time', 'last_time')
+
+    def __init__(self, n, P=0.2, I=0.0, D=0.0, current_time=None):
+        _numpy()
+        self.n = n
+        for name in self._FIELDS:
+            setattr(self, name, self._array(0.0))
+        self.Kp[:] = self._array(P)
+        self.Ki[:] = self._array(I)
+        self.Kd[:] = self._array(D)
+        self.current_time[:] = self._array(current_time if current_time is not None else time.time())
+        self.last_time[:] = self.current_time
+
+        self.clear()
+
+    def _array(self, value):
+        """Array of length n from a scalar or a sequence"""
+        if isinstance(value, (int, float)):
+            value = [float(value)] * self.n
+        elif len(value) != self.n:
+            raise ValueError("expected %d values, got %d" % (self.n, len(value)))
+        if np is not None:
+            return np.array(value, dtype=np.float64)
+        return array('d', value)
+
+    @classmethod
+    def from_pids(cls, pids):
+        """Creates a bank holding the gains and state of existing PID controllers"""
+        bank = cls(len(pids))
+        for name in cls._FIELDS:
+            getattr(bank, name)[:] = bank._array([float(getattr(pid, name)) for pid in pids])
+        return bank
+
+    def clear(self):
+        """Clears PID computations and coefficients of all controllers"""
+        for name in ('SetPoint', 'PTerm', 'ITerm', 'DTerm', 'last_error', 'int_error', 'output'):
+            getattr(self, name)[:] = self._array(0.0)
+
+        # Windup Guard
+        self.windup_guard[:] = self._array(20.0)
+
+    def update(self, feedback_values, current_time=None):
+        """Calculates PID values of all controllers for given reference feedbacks
+
+        :param feedback_values: n feedback values
+        :param current_time: a time shared by all controllers, or n times
+        :return: output array
+        """
+        current_time = current_time if current_time is not None else time.time()
+        if np is not None:
+            self._update_numpy(feedback_values, current_time)
+        else:
+            self._update_array(feedback_values, current_time)
+        return self.output
+
+    def _update_numpy(self, feedback_values, current_time):
+        error = self.SetPoint - np.asarray(feedback_values, dtype=np.float64)
+
+        self.current_time[:] = current_time
+        delta_time = self.current_time - self.last_time
+        delta_error = error - self.last_error
+
+        # count_nonzero is much cheaper than all()/any() on small arrays
+        n = self.n
+        due = np.count_nonzero(delta_time >= self.sample_time)
+        if due == n:
+            # all controllers are due, compute directly into the state arrays
+            np.multiply(self.Kp, error, out=self.PTerm)
+            i_term = self.ITerm
+            i_term += error * delta_time
+            guard = self.windup_guard
+            negative_guard = -guard
+            if np.count_nonzero(guard >= negative_guard) == n:
+                np.maximum(i_term, negative_guard, out=i_term)
+                np.minimum(i_term, guard, out=i_term)
+            else:
+                np.copyto(i_term, np.where(i_term < negative_guard, negative_guard,
+                                           np.where(i_term > guard, guard, i_term)))
+            d_term = self.DTerm
+            if np.count_nonzero(delta_time > 0) == n:
+                np.divide(delta_error, delta_time, out=d_term)
+            else:
+                d_term.fill(0.0)
+                np.divide(delta_error, delta_time, out=d_term, where=delta_time > 0)
+
+            # Remember last time and last error for next calculation
+            self.last_time[:] = self.current_time
+            self.last_error[:] = error
+
+            output = self.output
+            np.multiply(self.Ki, i_term, out=output)
+            output += self.PTerm
+            output += self.Kd * d_term
+            return
+        if due == 0:
+            return
+        due = delta_time >= self.sample_time
+
+        p_term = self.Kp * error
+        i_term = self.ITerm + error * delta_time
+        i_term = np.where(i_term < -self.windup_guard, -self.windup_guard,
+                          np.where(i_term > self.windup_guard, self.windup_guard, i_term))
+        d_term = np.zeros(self.n)
+        np.divide(delta_error, delta_time, out=d_term, where=delta_time > 0)
+        output = p_term + (self.Ki * i_term) + (self.Kd * d_term)
+
+        # Remember last time and last error for next calculation
+        np.copyto(self.PTerm, p_term, where=due)
+        np.copyto(self.ITerm, i_term, where=due)
+        np.copyto(self.DTerm, d_term, where=due)
+        np.copyto(self.output, output, where=due)
+        np.copyto(self.last_time, self.current_time, where=due)
+        np.copyto(self.last_error, error, where=due)
+
+    def _update_array(self, feedback_values, current_time):
+        times = [current_time] * self.n if isinstance(current_time, (int, float)) else current_time
+        set_point, kp, ki, kd = self.SetPoint, self.Kp, self.Ki, self.Kd
+        sample_time, windup_guard = self.sample_time, self.windup_guard
+        p_terms, i_terms, d_terms = self.PTerm, self.ITerm, self.DTerm
+        last_time, last_error, output = self.last_time, self.last_error, self.output
+        for i, feedback_value in enumerate(feedback_values):
+            error = set_point[i] - feedback_value
+
+            now = self.current_time[i] = times[i]
+            delta_time = now - last_time[i]
+            delta_error = error - last_error[i]
+
+            if delta_time >= sample_time[i]:
+                p_term = p_terms[i] = kp[i] * error
+                i_term = i_terms[i] + error * delta_time
+
+                guard = windup_guard[i]
+                if i_term < -guard:
+                    i_term = -guard
+                elif i_term > guard:
+                    i_term = guard
+                i_terms[i] = i_term
+
+                d_term = 0.0
+                if delta_time > 0:
+                    d_term = delta_error / delta_time
+                d_terms[i] = d_term
+
+                last_time[i] = now
+                last_error[i] = error
+
+                output[i] = p_term + (ki[i] * i_term) + (kd[i] * d_term)
@@ -0,0 +1,305 @@
+# This file is part of rsp_robot_hat_v3.
+# Copyright (C) 2021 Hiwonder Ltd. <support@hiwonder.com>
+#
+# rsp_robot_hat_v3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rsp_robot_hat_v3 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# title           :pid_sim.py
+# author          :Hiwonder, LuYongping(Lucas)
+# date            :20261018
+# notes           :numpy is optional
+# ==============================================================================
+
+import os
+import math
+import itertools
+import collections
+import concurrent.futures
+from . import pid
+
+METRICS = ('rise_time', 'overshoot', 'settling_time', 'iae')
+
+
+class FirstOrder:
+    """
+    一阶惯性环节  tau * dy/dt = gain * u - y
+    """
+
+    def __init__(self, gain=1.0, tau=0.1):
+        self.gain = gain
+        self.tau = tau
+
+    def state(self, y):
+        """
+        :param y: 初始输出, 标量或每组增益一个的数组
+        :return: 可变的状态列表, 交给 step 更新
+        """
+        return [y]
+
+    def step(self, state, u, dt):
+        """
+        前进一个仿真步长, 同一份公式既适用于标量也适用于 numpy 数组
+        :param state: state() 返回的状态
+        :param u: 控制量
+        :param dt: 步长(秒)
+        :return: 输出
+        """
+        y = state[0]
+        y = y + (self.gain * u - y) * (dt / self.tau)
+        state[0] = y
+        return y
+
+    def __repr__(self):
+        return "FirstOrder(gain=%g, tau=%g)" % (self.gain, self.tau)
+
+
+class SecondOrder:
+    """
+    二阶振荡环节  d2y/dt2 + 2 * zeta * wn * dy/dt + wn^2 * y = wn^2 * gain * u, 半隐式欧拉积分
+    """
+
+    def __init__(self, gain=1.0, wn=20.0, zeta=0.5):
+        self.gain = gain
+        self.wn = wn
+        self.zeta = zeta
+
+    def state(self, y):
+        return [y, y * 0.0]  # 输出, 速度
+
+    def step(self, state, u, dt):
+        y, v = state
+        v = v + (self.wn * self.wn * (self.gain * u - y) - 2.0 * self.zeta * self.wn * v) * dt
+        y = y + v * dt
+        state[0], state[1] = y, v
+        return y
+
+    def __repr__(self):
+        return "SecondOrder(gain=%g, wn=%g, zeta=%g)" % (self.gain, self.wn, self.zeta)
+
+
+class DeadTime(FirstOrder):
+    """
+    带纯延时的一阶环节, 近似串口舵机: 指令经总线与舵机内部处理后延迟 delay 秒才开始起作用
+    """
+
+    def __init__(self, gain=1.0, tau=0.1, delay=0.02):
+        super().__init__(gain, tau)
+        self.delay = delay
+
+    def state(self, y):
+        return [y, None]  # 输出, 延时队列(首次 step 时按步长创建)
+
+    def step(self, state, u, dt):
+        queue = state[1]
+        if queue is None:
+            queue = state[1] = collections.deque([state[0] * 0.0] * int(round(self.delay / dt)))
+        queue.append(u * 1.0)  # PIDBank.output 会被原地更新, 需要复制
+        u = queue.popleft()
+        y = state[0]
+        y = y + (self.gain * u - y) * (dt / self.tau)
+        state[0] = y
+        return y
+
+    def __repr__(self):
+        return "DeadTime(gain=%g, tau=%g, delay=%g)" % (self.gain, self.tau, self.delay)
+
+
+PLANTS = dict(first=FirstOrder, second=SecondOrder, dead=DeadTime)
+
+
+def _simulate_numpy(gains, plant, setpoint, dt, steps, sample_time, windup, limit, band):
+    np = pid._numpy()
+    n = len(gains)
+    gains = np.asarray(gains, dtype=np.float64)
+    bank = pid.PIDBank(n, gains[:, 0], gains[:, 1], gains[:, 2], current_time=0.0)
+    bank.SetPoint[:] = setpoint
+    bank.sample_time[:] = sample_time
+    bank.windup_guard[:] = windup
+
+    y = np.zeros(n)
+    state = plant.state(y)
+    peak = np.zeros(n)
+    t10 = np.full(n, np.nan)
+    t90 = np.full(n, np.nan)
+    last_out = np.zeros(n)  # 最后一次在误差带外的时刻
+    iae = np.zeros(n)
+    with np.errstate(all='ignore'):  # 不稳定的增益会溢出, 结果为 inf/nan, 排名时排在最后
+        for k in range(1, steps + 1):
+            t = k * dt
+            u = bank.update(y, t)
+            if limit is not None:
+                u = np.clip(u, -limit, limit)
+            y = plant.step(state, u, dt)
+            r = y / setpoint
+            np.maximum(peak, r, out=peak)
+            t10[np.isnan(t10) & (r >= 0.1)] = t
+            t90[np.isnan(t90) & (r >= 0.9)] = t
+            last_out[~(np.abs(r - 1.0) <= band)] = t
+            iae += np.abs(setpoint - y) * dt
+        settled = np.abs(r - 1.0) <= band
+    rise = t90 - t10
+    overshoot = np.maximum(peak - 1.0, 0.0) * 100.0
+    settling = np.where(settled, last_out + dt, np.inf)
+    return [(tuple(g), (float(a), float(b), float(c), float(d)))
+            for g, a, b, c, d in zip(gains.tolist(), rise, overshoot, settling, iae)]
+
+
+def _simulate_scalar(gains, plant, setpoint, dt, steps, sample_time, windup, limit, band):
+    results = []
+    for kp, ki, kd in gains:
+        controller = pid.PID(kp, ki, kd, current_time=0.0)
+        controller.SetPoint = setpoint
+        controller.setSampleTime(sample_time)
+        controller.setWindup(windup)
+        y = 0.0
+        state = plant.state(y)
+        peak, t10, t90, last_out, iae = 0.0, math.nan, math.nan, 0.0, 0.0
+        r = 0.0
+        try:
+            for k in range(1, steps + 1):
+                t = k * dt
+                controller.update(y, t)
+                u = controller.output
+                if limit is not None:
+                    u = min(max(u, -limit), limit)
+                y = plant.step(state, u, dt)
+                r = y / setpoint
+                peak = max(peak, r)
+                if t10 != t10 and r >= 0.1:
+                    t10 = t
+                if t90 != t90 and r >= 0.9:
+                    t90 = t
+                if not abs(r - 1.0) <= band:
+                    last_out = t
+                iae += abs(setpoint - y) * dt
+        except OverflowError:
+            r = math.nan
+        settling = last_out + dt if abs(r - 1.0) <= band else math.inf
+        results.append(((kp, ki, kd), (t90 - t10, max(peak - 1.0, 0.0) * 100.0, settling, iae)))
+    return results
+
+
+def _simulate_chunk(args):
+    # 进程池的任务, 模块级函数才能被 pickle
+    if pid._numpy() is not None:
+        return _simulate_numpy(*args)
+    return _simulate_scalar(*args)
+
+
+def grid(kp, ki, kd):
+    """
+    :param kp: Kp 的候选值
+    :param ki: Ki 的候选值
+    :param kd: Kd 的候选值
+    :return: 所有 (Kp, Ki, Kd) 组合的列表
+    """
+    return list(itertools.product(kp, ki, kd))
+
+
+def linspace(start, stop, count):
+    """
+    不依赖 numpy 的等间距取值
+    """
+    if count == 1:
+        return [float(start)]
+    return [start + (stop - start) * i / (count - 1) for i in range(count)]
+
+
+def sweep(plant, gains, setpoint=1.0, duration=2.0, dt=0.005, sample_time=0.0, windup=20.0, limit=None,
+          band=0.02, weights=None, workers=None):
+    """
+    对每组增益仿真一次阶跃响应, 按指标排序
+
+    控制器与 pid.PID.update 的计算完全一致(含 sample_time、windup_guard 与 D 项): 有 numpy 时
+    所有组合放进一个 pid.PIDBank 同步推进, 否则逐个使用 pid.PID. 每个仿真步长调用一次 update,
+    sample_time 大于 dt 时控制器按 PID 自己的规则跳过未到期的更新, 两次更新之间保持输出.
+
+    :param plant: 被控对象, 如 FirstOrder()、SecondOrder()、DeadTime(), 或 PLANTS 中的名称
+    :param gains: (Kp, Ki, Kd) 的列表, 可由 grid() 生成
+    :param setpoint: 阶跃目标, 被控对象从 0 开始
+    :param duration: 仿真时长(秒)
+    :param dt: 仿真步长(秒)
+    :param sample_time: PID 的 sample_time
+    :param windup: PID 的 windup_guard
+    :param limit: 控制量的饱和值, 如舵机的最大位置偏移, None 为不限制
+    :param band: 调节时间的误差带, 相对 setpoint
+    :param weights: {指标: 权重}, 指标见 METRICS, 默认各为 1
+    :param workers: 进程数, 默认有 numpy 时为 1(向量化已足够快), 否则为 CPU 核数
+    :return: 按 score 从小到大排序的 [{Kp, Ki, Kd, rise_time, overshoot, settling_time, iae, score}, ...],
+             时间单位为秒, overshoot 为百分比. 未达到 90% 或未进入误差带的组合 score 为 inf
+    """
+    if isinstance(plant, str):
+        plant = PLANTS[plant]()
+    if setpoint == 0:
+        raise ValueError("setpoint must not be 0")
+    weights = dict.fromkeys(METRICS, 1.0) if weights is None else weights
+    for name in weights:
+        if name not in METRICS:
+            raise ValueError("unknown metric %r" % name)
+    gains = [tuple(float(k) for k in g) for g in gains]
+    if not gains:
+        return []
+    steps = int(round(duration / dt))
+    if workers is None:
+        workers = 1 if pid._numpy() is not None else (os.cpu_count() or 1)
+    size = -(-len(gains) // (workers if pid._numpy() is not None else workers * 4))
+    chunks = [(gains[i:i + size], plant, setpoint, dt, steps, sample_time, windup, limit, band)
+              for i in range(0, len(gains), size)]
+    if workers > 1 and len(chunks) > 1:
+        with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+            simulated = [r for chunk in pool.map(_simulate_chunk, chunks) for r in chunk]
+    else:
+        simulated = [r for chunk in map(_simulate_chunk, chunks) for r in chunk]
+
+    results = []
+    for (kp, ki, kd), metrics in simulated:
+        result = dict(Kp=kp, Ki=ki, Kd=kd)
+        result.update(zip(METRICS, metrics))
+        results.append(result)
+    _score(results, weights)
+    results.sort(key=lambda r: r['score'])
+    return results
+
+
+def _score(results, weights):
+    # 各指标除以所有有效组合的中位数后加权求和, 量纲不同的指标可以相加
+    valid = [r for r in results if all(math.isfinite(r[m]) for m in METRICS)]
+    scales = {}
+    for m in METRICS:
+        values = sorted(r[m] for r in valid)
+        median = values[len(values) // 2] if values else 0.0
+        scales[m] = median if median > 0 else 1.0
+    for r in results:
+        if all(math.isfinite(r[m]) for m in METRICS):
+            r['score'] = sum(w * r[m] / scales[m] for m, w in weights.items())
+        else:
+            r['score'] = math.inf
+
+
+def report(results, top=10, plant=None):
+    """
+    :param results: sweep() 的返回值
+    :param top: 列出的组合数
+    :param plant: 被控对象, 写在标题中
+    :return: 排名表文本
+    """
+    valid = sum(1 for r in results if math.isfinite(r['score']))
+    lines = ["%d gain sets%s, %d reach the setpoint and settle" %
+             (len(results), " on %r" % (plant,) if plant is not None else "", valid),
+             "%4s %9s %9s %9s %10s %10s %12s %10s %8s" %
+             ('rank', 'Kp', 'Ki', 'Kd', 'rise(ms)', 'overshoot%', 'settling(ms)', 'IAE', 'score')]
+    for i, r in enumerate(results[:top]):
+        lines.append("%4d %9.4g %9.4g %9.4g %10.1f %10.2f %12.1f %10.4g %8.3f" %
+                     (i + 1, r['Kp'], r['Ki'], r['Kd'], r['rise_time'] * 1000, r['overshoot'],
+                      r['settling_time'] * 1000, r['iae'], r['score']))
+    return '\n'.join(lines)
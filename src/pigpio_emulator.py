@@ -0,0 +1,158 @@
+# This file is part of rsp_robot_hat_v3.
+# Copyright (C) 2021 Hiwonder Ltd. <support@hiwonder.com>
+#
+# rsp_robot_hat_v3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rsp_robot_hat_v3 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# title           :pigpio_emulator.py
+# author          :Hiwonder, LuYongping(Lucas)
+# date            :20261018
+# notes           :stand-in pigpiod on a local tcp port
+# ==============================================================================
+
+import time
+import socket
+import select
+import threading
+from . import _pwm_output
+from ._pwm_output import PI_CMD_SERVO, PI_CMD_GPW, PI_CMD_HP, HARDWARE_PWM_PINS, HARDWARE_PWM_RANGE
+from ._pwm_output import PI_MIN_SERVO_PULSEWIDTH, PI_MAX_SERVO_PULSEWIDTH
+from ._pwm_output import _cmd_struct, _res_struct
+
+PI_BAD_PULSEWIDTH = -7
+PI_NOT_HPWM_GPIO = -95
+PI_BAD_HPWM_DUTY = -97
+
+
+class VirtualPigpiod:
+    """
+    监听本地 tcp 端口的虚拟 pigpiod
+
+    按 pigpiod 的 socket 协议应答舵机脉宽和硬件 PWM 相关的指令, 记录每次输出的通道、脉宽或占空比和时刻,
+    其它指令一律返回 0.
+    可以配置每次收到数据后的处理延时, 用于在没有硬件的环境中测量和回归测试 PWM 输出.
+
+        daemon = VirtualPigpiod(delay=0.0001)
+        daemon.attach()  # 将 PWM 舵机的输出切换到虚拟守护进程
+    """
+
+    def __init__(self, delay=0.0, keep=100000):
+        """
+        :param delay: 每次收到数据后、处理指令前的延时(秒), 模拟守护进程的唤醒与处理耗时
+        :param keep: 最多保留的输出记录条数
+        """
+        self.delay = delay
+        self.keep = keep
+        self.widths = {}  # pin: 当前脉宽
+        self.history = []  # (时刻, pin, 脉宽)
+        self.hardware = {}  # pin: (频率, 占空比), 硬件 PWM 的当前输出
+        self.duty_cycles = []  # (时刻, pin, 频率, 占空比)
+        self.commands = 0
+        self.receives = 0
+        self.errors = 0
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind(('127.0.0.1', 0))
+        self._server.listen(4)
+        self.host, self.port = self._server.getsockname()
+        self._stop_r, self._stop_w = socket.socketpair()
+        self._thread = threading.Thread(target=self._daemon_task, daemon=True)
+        self._thread.start()
+
+    def attach(self):
+        """
+        将 PWM 舵机的输出切换到虚拟守护进程
+        :return: _pwm_output.PigpioOutput
+        """
+        output = _pwm_output.PigpioOutput(self.host, self.port).connect()
+        _pwm_output.use_output(output)
+        return output
+
+    def close(self):
+        self._stop_w.send(b'\0')
+        self._thread.join()
+        for sock in (self._server, self._stop_r, self._stop_w):
+            sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _execute(self, cmd, p1, p2, ext, now):
+        if cmd == PI_CMD_HP:
+            duty = int.from_bytes(ext[:4], 'little')
+            if p1 not in HARDWARE_PWM_PINS:
+                return PI_NOT_HPWM_GPIO
+            if duty > HARDWARE_PWM_RANGE:
+                self.errors += 1
+                return PI_BAD_HPWM_DUTY
+            if p2 == 0:
+                self.hardware.pop(p1, None)
+            else:
+                self.hardware[p1] = (p2, duty)
+            if len(self.duty_cycles) < self.keep:
+                self.duty_cycles.append((now, p1, p2, duty))
+            return 0
+        if cmd == PI_CMD_SERVO:
+            if p2 != 0 and not PI_MIN_SERVO_PULSEWIDTH <= p2 <= PI_MAX_SERVO_PULSEWIDTH:
+                self.errors += 1
+                return PI_BAD_PULSEWIDTH
+            self.widths[p1] = p2
+            if len(self.history) < self.keep:
+                self.history.append((now, p1, p2))
+            return 0
+        if cmd == PI_CMD_GPW:
+            return self.widths.get(p1, 0)
+        return 0
+
+    def _daemon_task(self):
+        clients = {}  # socket: 接收缓存
+        while True:
+            readable = select.select([self._server, self._stop_r] + list(clients), [], [])[0]
+            if self._stop_r in readable:
+                break
+            for sock in readable:
+                if sock is self._server:
+                    client = self._server.accept()[0]
+                    client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    clients[client] = bytearray()
+                    continue
+                data = sock.recv(65536)
+                if not data:
+                    del clients[sock]
+                    sock.close()
+                    continue
+                self.receives += 1
+                if self.delay:
+                    time.sleep(self.delay)
+                buf = clients[sock]
+                buf += data
+                replies = []
+                while len(buf) >= _cmd_struct.size:
+                    cmd, p1, p2, p3 = _cmd_struct.unpack_from(buf)
+                    if len(buf) < _cmd_struct.size + p3:
+                        break
+                    ext = bytes(buf[_cmd_struct.size:_cmd_struct.size + p3])
+                    del buf[:_cmd_struct.size + p3]
+                    self.commands += 1
+                    res = self._execute(cmd, p1, p2, ext, time.perf_counter())
+                    replies.append(_res_struct.pack(cmd, p1, p2, res))
+                if replies:
+                    sock.sendall(b''.join(replies))
+        for sock in clients:
+            sock.close()
+
+    def stats(self):
+        return dict(commands=self.commands, receives=self.receives, errors=self.errors)
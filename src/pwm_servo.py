@@ -21,8 +21,165 @@
 # ==============================================================================
 
 import time
+import heapq
+import itertools
 import threading
-from ._common import _pi
+from . import _pwm_output
+from . import trajectory
+
+
+class _MotionScheduler:
+    """
+    所有 PwmServo 共用的插值调度线程
+
+    正在转动的舵机按下一次更新的时间放在最小堆中, 没有舵机转动时线程阻塞在条件变量上, 不再周期性唤醒.
+    更新时刻是从固定起点开始、按频率排列的绝对时间, 睡眠误差和输出耗时不会累积;
+    舵机位置由转动开始后经过的时间算出, 最后一次更新安排在转动的结束时刻.
+    同一时刻到期的舵机在一个 tick 中一起计算, 变化的通道随后通过 _pwm_output 在一次 pigpiod 往返中一起输出.
+    """
+
+    MIN_RATE = 50
+    MAX_RATE = 400
+
+    def __init__(self, rate=50):
+        self.period = 1.0 / rate
+        self.ticks = 0
+        self.cpu_time = 0.0  # 所有 tick 的 CPU 时间之和(秒)
+        self.cpu_max = 0.0  # 单个 tick 的最大 CPU 时间(秒)
+        self.moves = 0
+        self.move_error_total = 0.0  # 转动实际结束时刻与要求时刻之差的累计(秒)
+        self.move_error_max = 0.0
+        self.errors = 0  # 输出失败的 tick 数
+        self.last_error = None  # 最近一次输出失败的异常
+        self._heap = []  # (到期时间, 序号, 舵机)
+        self._active = set()
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._epoch = time.monotonic()
+
+    @property
+    def rate(self):
+        return 1.0 / self.period
+
+    def set_rate(self, rate):
+        """
+        设置插值频率
+        :param rate: 50~400Hz
+        """
+        if not self.MIN_RATE <= rate <= self.MAX_RATE:
+            raise ValueError("rate out of range. it must be between %d~%dHz" % (self.MIN_RATE, self.MAX_RATE))
+        with self._cond:
+            self.period = 1.0 / rate
+            self._epoch = time.monotonic()
+
+    def _due(self, servo, t):
+        # 所有舵机对齐到同一组 tick 时刻, 同时转动的舵机在同一个 tick 中更新; 转动在两个 tick 之间结束时按结束时刻
+        tick = self._epoch + ((t - self._epoch) // self.period + 1) * self.period
+        return min(tick, servo.move_end)
+
+    def add(self, servo):
+        """
+        开始调度一个舵机, 舵机已在调度中时不做处理
+        """
+        with self._cond:
+            if servo in self._active:
+                return
+            self._active.add(servo)
+            heapq.heappush(self._heap, (self._due(servo, time.monotonic()), next(self._seq), servo))
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def _run(self):
+        heap = self._heap
+        while True:
+            with self._cond:
+                while True:
+                    if not heap:
+                        self._cond.wait()
+                        continue
+                    delay = heap[0][0] - time.monotonic()
+                    if delay <= 0:
+                        break
+                    self._cond.wait(delay)
+                now = time.monotonic()
+                batch = []
+                while heap and heap[0][0] <= now:
+                    batch.append(heapq.heappop(heap)[2])
+
+            cpu = time.thread_time()
+            updates = []
+            for servo in batch:
+                width = servo._step(now)
+                if width is not None:
+                    updates.append((servo.pin, width))
+            failed = self._output(updates)
+            for servo in batch:
+                if servo.pin in failed:
+                    with servo.lock:
+                        servo.moving = False  # 输出失败的舵机停止转动, 不影响其它舵机
+            with self._cond:
+                # 在条件变量的锁内判断是否仍在转动, 与 add() 互斥, 不会漏掉刚设置的新目标
+                for servo in batch:
+                    if servo.moving:
+                        heapq.heappush(heap, (self._due(servo, now), next(self._seq), servo))
+                    else:
+                        self._active.discard(servo)
+            for servo in batch:
+                if servo.move_error is not None and servo.move_end <= now:
+                    self.moves += 1
+                    self.move_error_total += servo.move_error
+                    self.move_error_max = max(self.move_error_max, servo.move_error)
+            cpu = time.thread_time() - cpu
+            self.ticks += 1
+            self.cpu_time += cpu
+            self.cpu_max = max(self.cpu_max, cpu)
+
+    def _output(self, updates):
+        """
+        本 tick 所有变化的通道在一次往返中输出, 异常只记录不抛出, 调度线程继续运行
+        :return: 输出失败的 gpio 集合
+        """
+        try:
+            _pwm_output.output().set_pulsewidths(updates)
+        except Exception as e:
+            self.errors += 1
+            self.last_error = e
+            if isinstance(e, _pwm_output.PigpioError):
+                return set(e.pins)
+            return {pin for pin, _ in updates}  # 连接断开等错误, 整批都未确认输出
+        return ()
+
+    def stats(self):
+        """
+        :return: {rate, ticks, cpu_time, cpu_max, cpu_avg, active, moves, move_error_avg, move_error_max,
+                  errors, last_error}
+        """
+        return dict(rate=self.rate, ticks=self.ticks, cpu_time=self.cpu_time, cpu_max=self.cpu_max,
+                    cpu_avg=self.cpu_time / self.ticks if self.ticks else 0.0, active=len(self._active),
+                    moves=self.moves, move_error_avg=self.move_error_total / self.moves if self.moves else 0.0,
+                    move_error_max=self.move_error_max, errors=self.errors,
+                    last_error=repr(self.last_error) if self.last_error is not None else None)
+
+
+scheduler = _MotionScheduler()
+
+
+def set_rate(rate):
+    """
+    设置所有 PWM 舵机的插值频率
+    :param rate: 50~400Hz
+    """
+    scheduler.set_rate(rate)
+
+
+def stats():
+    """
+    :return: {scheduler: 插值调度的统计, output: pigpiod 输出的统计, 见 metrics.BusMetrics.stats}
+    """
+    return dict(scheduler=scheduler.stats(), output=_pwm_output.bus_metrics.stats())
 
 
 class PwmServo:
@@ -32,13 +189,18 @@ class PwmServo:
         self.min_width = min_width
         self.max_width = max_width
         self.deviation = deviation
-        self.inc_times = 0
         self.pos_cur = 1500
         self.pos_set = self.pos_cur
-        self.pos_inc = 0
+        self.moving = False
+        self.move_end = 0.0
+        self.move_error = None  # 上一次转动实际结束时刻与要求时刻之差(秒)
+        self._move_from = self.pos_cur
+        self._move_start = 0.0
+        self._move_duration = 0.0
+        self._move_table = None  # 非线性转动的位移表, 见 trajectory.profile
+        self._move_rate = 0
+        self.frequency = None  # 使用硬件 PWM 时的频率, None 为 pigpio 软件 PWM
         self.lock = threading.Lock()
-        self.thread = threading.Thread(target=self.update_pos_task, daemon=True)
-        self.thread.start()
 
     def get_position(self):
         """
@@ -46,45 +208,86 @@ class PwmServo:
         """
         return self.pos_cur
 
-    def set_position(self, new_pos, duration=0):
+    def set_position(self, new_pos, duration=0, profile=trajectory.LINEAR, v_max=None):
         """
         :param new_pos:
-        :param duration:
+        :param duration: 转动时间(毫秒), 在这段时间内按 scheduler 的频率插值
+        :param profile: 速度曲线, 见 trajectory.PROFILES
+        :param v_max: 速度上限(微秒/秒), 为 None 时不限速. 超速时延长转动时间, 见 trajectory.limit_duration
         :return:
         """
-        if not self.min_width <= new_pos <= self.max_width:
-            raise ValueError("new position out of pulse width range")
+        low, high = self.limits()
+        if not low <= new_pos <= high:
+            raise ValueError("new position out of pulse width range. it must be between %d~%d" % (low, high))
         new_pos = int(new_pos)
         if duration < 0:
             raise ValueError("duration must be not less than 0")
-        elif duration == 0:
+        if v_max is not None:
+            duration = trajectory.limit_duration(new_pos - self.pos_cur, duration, profile, v_max)
+        if duration == 0:
             with self.lock:
-                self.pos_set = new_pos
-                self.pos_cur = new_pos
-                _pi.set_servo_pulsewidth(self.pin, self.pos_cur + self.deviation)
+                _pwm_output.output().set_pulsewidths([self._hold(new_pos)])
         else:
-            duration = 20 if duration < 20 else duration
-            duration = 30000 if duration > 30000 else duration
-            inc_times = int(duration / 20 + 0.5)
+            if duration > 30000:
+                duration, v_max = 30000, None
+            rate = scheduler.rate
             with self.lock:
-                self.inc_times = inc_times
+                if profile == trajectory.LINEAR:
+                    self._move_table = None
+                else:
+                    self._move_table = trajectory.profile(new_pos - self.pos_cur, duration, profile, rate, v_max)
+                    self._move_rate = rate
+                self._move_from = self.pos_cur
+                self._move_start = time.monotonic()
+                self._move_duration = duration / 1000.0
+                self.move_end = self._move_start + self._move_duration
+                self.move_error = None
                 self.pos_set = new_pos
-                self.pos_inc = (self.pos_cur - new_pos) / inc_times
+                self.moving = True
+            scheduler.add(self)
 
-    def update_pos_task(self):
-        while True:
-            with self.lock:
-                self.inc_times -= 1
-                if self.inc_times > 0:
-                    pos_cur = self.pos_set + int(self.pos_inc * self.inc_times)
-                    _pi.set_servo_pulsewidth(self.pin, pos_cur + self.deviation)
-                    self.pos_cur = pos_cur
-                elif self.inc_times == 0:
-                    _pi.set_servo_pulsewidth(self.pin, self.pos_set + self.deviation)
-                    self.pos_cur = self.pos_set
-                else:
-                    self.inc_times = -1
-            time.sleep(0.02)
+    def limits(self):
+        """
+        :return: (最小, 最大) 可设置的位置, 为 min_width~max_width 与守护进程接受的脉宽范围(扣除偏差)的交集
+        """
+        if self.frequency is not None:
+            return self.min_width, self.max_width
+        return (max(self.min_width, _pwm_output.PI_MIN_SERVO_PULSEWIDTH - self.deviation),
+                min(self.max_width, _pwm_output.PI_MAX_SERVO_PULSEWIDTH - self.deviation))
+
+    def _hold(self, new_pos):
+        """
+        取消正在进行的插值并直接停在新位置, 需在持有 lock 时调用
+        :param new_pos: 已检查范围的脉宽
+        :return: 要输出的 (pin, 脉宽)
+        """
+        self.moving = False
+        self.pos_set = new_pos
+        self.pos_cur = new_pos
+        return self.pin, new_pos + self.deviation
+
+    def _step(self, now):
+        """
+        按经过的时间更新位置, 由调度线程调用
+        :param now: 本次更新的时刻
+        :return: 要输出的脉宽, 位置没有变化时为 None
+        """
+        with self.lock:
+            if not self.moving:
+                return None
+            elapsed = now - self._move_start
+            if elapsed >= self._move_duration:
+                pos = self.pos_set
+                self.moving = False
+                self.move_error = elapsed - self._move_duration
+            elif self._move_table is not None:
+                pos = self._move_from + trajectory.sample(self._move_table, elapsed, self._move_rate)
+            else:
+                pos = self._move_from + int((self.pos_set - self._move_from) * elapsed / self._move_duration)
+            if pos == self.pos_cur and self.moving:
+                return None
+            self.pos_cur = pos
+            return pos + self.deviation
 
     def set_deviation(self, new_deviation=0):
         """
@@ -104,6 +307,46 @@ class PwmServo:
         """
         return self.deviation
 
+    def set_frequency(self, frequency=None):
+        """
+        使用硬件 PWM 输出, 频率可调且没有软件 PWM 的采样量化与抖动. 只有 gpio 12/13/18/19 支持,
+        不支持或守护进程拒绝时继续使用软件 PWM
+
+        :param frequency: 硬件 PWM 频率(Hz), 如数字舵机可用 333. 为 None 时切换回软件 PWM(50Hz)
+        :return: 是否在使用硬件 PWM
+        """
+        output = _pwm_output.output()
+        with self.lock:
+            if frequency is None:
+                output.use_software_pwm(self.pin, self.pos_cur + self.deviation)
+                self.frequency = None
+                return False
+            if not 0 < frequency * self.max_width <= 1000000:
+                raise ValueError("frequency out of range. the period must be longer than max width")
+            if output.use_hardware_pwm(self.pin, int(frequency), self.pos_cur + self.deviation):
+                self.frequency = int(frequency)
+                return True
+            self.frequency = None
+            return False
+
+    def get_frequency(self):
+        """
+        :return: 硬件 PWM 频率, 使用软件 PWM 时为 None
+        """
+        return self.frequency
+
+
+_servo_pins = dict(servo1=12, servo2=13)
+_servos_lock = threading.Lock()
+
 
-servo1 = PwmServo(12)
-servo2 = PwmServo(13)
+def __getattr__(name):
+    # servo1、servo2 在首次访问时才创建
+    if name in _servo_pins:
+        with _servos_lock:
+            servo = globals().get(name)
+            if servo is None:
+                servo = PwmServo(_servo_pins[name])
+                globals()[name] = servo
+        return servo
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
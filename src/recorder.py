@@ -0,0 +1,213 @@
+# This file is part of rsp_robot_hat_v3.
+# Copyright (C) 2021 Hiwonder Ltd. <support@hiwonder.com>
+#
+# rsp_robot_hat_v3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rsp_robot_hat_v3 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# title           :recorder.py
+# author          :Hiwonder, LuYongping(Lucas)
+# date            :20261018
+# notes           :
+# ==============================================================================
+
+import time
+import threading
+import contextlib
+import sqlite3 as sql
+from array import array
+from . import serial_servo
+
+INSERT_BATCH = 500  # 每个事务写入的行数
+
+
+def simplify(times, poses, width, tolerance):
+    """
+    按允许误差精简折线(Ramer-Douglas-Peucker), 误差为同一时刻各舵机的实际位置与两端关键帧线性插值之差的最大值
+    :param times: 采样时刻的序列
+    :param poses: 依次为每次采样中各舵机位置的序列
+    :param width: 每次采样的舵机数量
+    :param tolerance: 允许误差
+    :return: 保留的采样序号的列表, 包含首尾
+    """
+    count = len(times)
+    if count <= 2:
+        return list(range(count))
+    keep = bytearray(count)
+    keep[0] = keep[-1] = 1
+    stack = [(0, count - 1)]
+    while stack:
+        a, b = stack.pop()
+        if b - a < 2:
+            continue
+        ta, span = times[a], times[b] - times[a]
+        pa, pb = poses[a * width:(a + 1) * width], poses[b * width:(b + 1) * width]
+        worst, worst_error = a, -1.0
+        for i in range(a + 1, b):
+            f = (times[i] - ta) / span if span > 0 else 0.0
+            base = i * width
+            error = max(abs(poses[base + j] - (pa[j] + (pb[j] - pa[j]) * f)) for j in range(width))
+            if error > worst_error:
+                worst, worst_error = i, error
+        if worst_error > tolerance:
+            keep[worst] = 1
+            stack.append((a, worst))
+            stack.append((worst, b))
+    return [i for i in range(count) if keep[i]]
+
+
+class PoseRecorder:
+    """
+    以固定频率读取一组串口舵机的位置, 录制为动作组文件
+
+    手动摆动掉电的舵机录制动作, 保存前按允许误差精简关键帧:
+
+        with PoseRecorder([1, 2, 3], rate=50) as rec:
+            time.sleep(10)
+        report = rec.save('wave.d6a', tolerance=3)
+
+    舵机id不是 1~N 时, 播放时用 ActionSet(path, servos=ids) 指定各列对应的舵机.
+    """
+
+    def __init__(self, ids, rate=50, retry=1):
+        """
+        :param ids: 舵机id
+        :param rate: 采样频率(Hz)
+        :param retry: 每次读取的最多尝试次数, 读取失败时沿用该舵机上一次的位置,
+                      所有舵机都至少读到过一次之后才开始记录采样
+        """
+        self.ids = tuple(ids)
+        self.rate = rate
+        self.retry = retry
+        self.times = array('d')  # 相对开始时刻的采样时刻(秒)
+        self.poses = array('h')  # 依次为每次采样中各舵机的位置
+        self.failures = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """
+        清空已录制的数据并开始录制
+        """
+        if self.running:
+            return
+        del self.times[:]
+        del self.poses[:]
+        self.failures = 0
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._record_task, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def record(self, seconds):
+        """
+        阻塞录制指定时间
+        :param seconds:
+        :return: self
+        """
+        self.start()
+        self._stop.wait(seconds)
+        self.stop()
+        return self
+
+    def _record_task(self):
+        period = 1.0 / self.rate
+        last = [None] * len(self.ids)
+        missing = len(self.ids)  # 还没有读到过位置的舵机数
+        start = deadline = time.monotonic()
+        while not self._stop.is_set():
+            now = time.monotonic()
+            for j, id_ in enumerate(self.ids):
+                pos = serial_servo.get_position(id_, self.retry)
+                if pos is None:
+                    self.failures += 1
+                else:
+                    if last[j] is None:
+                        missing -= 1
+                    last[j] = pos[0]
+            if not missing:
+                self.times.append(now - start)
+                self.poses.extend(last)
+            # 按绝对时刻排定下一次采样, 读取耗时超过周期时跳到下一个未过期的时刻
+            deadline += period
+            now = time.monotonic()
+            if deadline < now:
+                deadline += (now - deadline) // period * period + period
+            self._stop.wait(deadline - now)
+
+    def save(self, path, tolerance=2):
+        """
+        精简关键帧后写入动作组文件, 文件中已有的 ActionGroup 表会被替换
+        :param path: 动作组文件路径
+        :param tolerance: 允许的最大位置误差, 为 0 时保留所有采样
+        :return: {samples, keyframes, duration, rate, compression, max_error, failures}
+        """
+        if self.running:
+            raise RuntimeError("stop recording before saving")
+        width, times, poses = len(self.ids), self.times, self.poses
+        kept = simplify(times, poses, width, tolerance) if tolerance > 0 else list(range(len(times)))
+        rows, last_ms = [], 0
+        for k, i in enumerate(kept):
+            t_ms = int(round(times[i] * 1000))
+            duration = t_ms - last_ms if k else int(1000 / self.rate)
+            last_ms = t_ms
+            rows.append((duration,) + tuple(poses[i * width:(i + 1) * width]))
+
+        columns = ''.join(', Servo%d INT' % j for j in range(1, width + 1))
+        placeholders = ', '.join('?' * (width + 1))
+        with contextlib.closing(sql.connect(path, isolation_level=None)) as ag:
+            ag.execute("pragma journal_mode=wal")
+            ag.execute("begin")
+            ag.execute("drop table if exists ActionGroup")
+            ag.execute("create table ActionGroup([Index] INTEGER PRIMARY KEY AUTOINCREMENT, Time INT%s)" % columns)
+            ag.execute("commit")
+            names = ', '.join(['Time'] + ['Servo%d' % j for j in range(1, width + 1)])
+            for b in range(0, len(rows), INSERT_BATCH):
+                ag.execute("begin")
+                ag.executemany("insert into ActionGroup(%s) values (%s)" % (names, placeholders),
+                               rows[b:b + INSERT_BATCH])
+                ag.execute("commit")
+
+        samples = len(times)
+        duration = times[-1] - times[0] if samples > 1 else 0.0
+        return dict(samples=samples, keyframes=len(kept), duration=duration,
+                    rate=(samples - 1) / duration if duration > 0 else 0.0,
+                    compression=samples / len(kept) if kept else 0.0,
+                    max_error=self._max_error(kept), failures=self.failures)
+
+    def _max_error(self, kept):
+        # 按关键帧线性插值重建每次采样的位置, 与实际采样之差的最大值
+        width, times, poses = len(self.ids), self.times, self.poses
+        error = 0.0
+        for a, b in zip(kept, kept[1:]):
+            span = times[b] - times[a]
+            for i in range(a + 1, b):
+                f = (times[i] - times[a]) / span if span > 0 else 0.0
+                for j in range(width):
+                    pa, pb = poses[a * width + j], poses[b * width + j]
+                    error = max(error, abs(poses[i * width + j] - (pa + (pb - pa) * f)))
+        return error
@@ -21,10 +21,243 @@
 # ==============================================================================
 
 import time
+import threading
+import contextlib
 from .misc import set_bounds
 from . import _serial_servo_commands as _ssc
-
-_ssc.port_init()
+from .bus_arbiter import DeadlineExceeded
+
+
+class ConfigCache:
+    """
+    静态配置寄存器(id、偏差、转动范围、电压范围、温度报警、负载状态)的写穿缓存
+
+    默认关闭, enable() 后 get_* 优先返回缓存值, 本模块中对应的 set_*/unload 等写操作会同步更新或作废缓存.
+    通过其它途径改动了舵机配置时需调用 invalidate() 或 refresh().
+    """
+    COMMANDS = (_ssc.ID_READ, _ssc.ANGLE_OFFSET_READ, _ssc.ANGLE_LIMIT_READ,
+                _ssc.VIN_LIMIT_READ, _ssc.TEMP_MAX_LIMIT_READ, _ssc.LOAD_OR_UNLOAD_READ)
+
+    def __init__(self):
+        self.enabled = False
+        self.hits = 0
+        self.misses = 0
+        self._values = {}  # {id_: {cmd: value}}
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+        if not enabled:
+            self._values.clear()
+
+    def read(self, id_, cmd, retry=50):
+        """
+        读取配置寄存器, 缓存命中时不访问总线
+        :param id_:
+        :param cmd: 读指令
+        :param retry:
+        :return:
+        """
+        value = self._lookup(id_, cmd)
+        if value is None:
+            value = _ssc.read_msg(id_, cmd, retry)
+            self._store(id_, cmd, value)
+        return value
+
+    def _lookup(self, id_, cmd):
+        # 命中时返回缓存的值, 否则返回 None 并计入 misses; serial_servo_aio 也经由这里读写缓存
+        if not self.enabled:
+            return None
+        values = self._values.get(id_)
+        if values is not None and cmd in values:
+            self.hits += 1
+            return values[cmd]
+        self.misses += 1
+        return None
+
+    def _store(self, id_, cmd, value):
+        if self.enabled and value is not None:
+            self._values.setdefault(id_, {})[cmd] = value
+
+    def update(self, id_, cmd, value):
+        """
+        写操作后更新缓存, 写广播id时作废所有舵机的该寄存器
+        """
+        if id_ == _ssc.BROADCAST_ID:
+            self.invalidate(id_, cmd)
+        elif self.enabled:
+            self._values.setdefault(id_, {})[cmd] = value
+
+    def invalidate(self, id_=None, cmd=None):
+        """
+        作废缓存
+        :param id_: 舵机id, 为空或为广播id时作废所有舵机
+        :param cmd: 读指令, 为空时作废该舵机的所有寄存器
+        """
+        if id_ is None or id_ == _ssc.BROADCAST_ID:
+            if cmd is None:
+                self._values.clear()
+            else:
+                for values in self._values.values():
+                    values.pop(cmd, None)
+        elif cmd is None:
+            self._values.pop(id_, None)
+        else:
+            self._values.get(id_, {}).pop(cmd, None)
+
+    def refresh(self, id_, retry=50):
+        """
+        从总线重新读取一个舵机的所有配置寄存器
+        :param id_:
+        :param retry:
+        :return: {读指令: 值}
+        """
+        self.invalidate(id_)
+        values = {}
+        for cmd in self.COMMANDS:
+            value = _ssc.read_msg(id_, cmd, retry)
+            if value is not None:
+                values[cmd] = value
+        if self.enabled:
+            self._values[id_] = dict(values)
+        return values
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, servos=len(self._values))
+
+
+config_cache = ConfigCache()
+
+
+class MoveCoalescer:
+    """
+    位置指令合并发送队列
+
+    启用后 set_position/set_positions 只把目标放入队列, 每个舵机只保留最新的一条 MOVE_TIME_WRITE,
+    后台线程每个总线时隙(period)把剩下的指令合成一次突发写出. 被新目标覆盖而没有发出的指令计入 dropped,
+    被 stop/unload 作废的指令计入 cancelled. 突发在总线仲裁器中等待超过期限而没有发出时计入 expired,
+    其中的指令在没有更新的目标时放回队列, 下一个时隙重发.
+    """
+
+    def __init__(self, period=0.01):
+        """
+        :param period: 两次突发写入的最小间隔(秒)
+        """
+        self.period = period
+        self.submitted = 0
+        self.dropped = 0
+        self.sent = 0
+        self.bursts = 0
+        self.cancelled = 0
+        self.expired = 0
+        self._pending = {}  # {id_: (position, duration)}
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()  # 取出并写出一次突发的全过程, 见 preempt()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._flush_task, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        停止后台线程, 队列中剩余的指令会先被发出
+        """
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            self._stop.set()
+            self._wake.set()
+            thread.join()
+
+    def put(self, positions):
+        """
+        :param positions: (id_, position, duration) 的可迭代对象
+        """
+        with self._lock:
+            pending = self._pending
+            for id_, position, duration in positions:
+                if id_ in pending:
+                    self.dropped += 1
+                pending[id_] = (position, duration)
+                self.submitted += 1
+        self._wake.set()
+
+    def cancel(self, id_=None):
+        """
+        作废队列中尚未发出的转动指令
+        :param id_: 舵机id, 为空或为广播id时作废所有舵机
+        :return: 作废的指令数
+        """
+        with self._lock:
+            if id_ is None or id_ == _ssc.BROADCAST_ID:
+                count = len(self._pending)
+                self._pending.clear()
+            else:
+                count = 1 if self._pending.pop(id_, None) is not None else 0
+            self.cancelled += count
+        return count
+
+    @contextlib.contextmanager
+    def preempt(self, id_=None):
+        """
+        作废该舵机排队中的转动指令并等待正在写出的突发完成, 退出前不会再发出新的突发.
+        stop/unload 在其中写入, 之后才发出的旧目标不会撤销停止或掉电
+        :param id_: 舵机id, 为空或为广播id时作废所有舵机
+        """
+        with self._send_lock:
+            self.cancel(id_)
+            yield
+
+    def flush(self):
+        """
+        立即把队列中的指令合成一次突发写出
+        """
+        with self._send_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if pending:
+                try:
+                    _ssc.write_cmds(_move_cmds(pending))
+                except DeadlineExceeded:
+                    self.expired += 1
+                    with self._lock:
+                        for id_, target in pending.items():
+                            self._pending.setdefault(id_, target)
+                    self._wake.set()
+                    return
+                self.sent += len(pending)
+                self.bursts += 1
+
+    def _flush_task(self):
+        while not self._stop.is_set():
+            self._wake.wait()
+            self._wake.clear()
+            self.flush()
+            self._stop.wait(self.period)
+        self.flush()
+
+    def stats(self):
+        return dict(submitted=self.submitted, dropped=self.dropped, sent=self.sent, bursts=self.bursts,
+                    cancelled=self.cancelled, expired=self.expired, pending=len(self._pending))
+
+
+move_queue = MoveCoalescer()
+
+
+def stats():
+    """
+    串口总线的统计: 收发字节数、校验错误、等锁时间以及每种指令和每个舵机的次数、重试、失败与延时分布
+    :return: 见 metrics.BusMetrics.stats
+    """
+    return _ssc.bus_metrics.stats()
 
 
 def set_id(new_id, old_id=0xFE):
@@ -35,6 +268,9 @@ def set_id(new_id, old_id=0xFE):
     :return:
     """
     _ssc.write_cmd(old_id, _ssc.ID_WRITE, new_id)
+    config_cache.invalidate(old_id)
+    config_cache.invalidate(new_id)
+    config_cache.invalidate(_ssc.BROADCAST_ID, _ssc.ID_READ)
 
 
 def get_id(id_=None, retry=50):
@@ -45,7 +281,7 @@ def get_id(id_=None, retry=50):
     :return: 返回舵机id
     """
     id_ = id_ if id_ else 0xFE
-    return _ssc.read_msg(id_, _ssc.ID_READ, retry)
+    return config_cache.read(id_, _ssc.ID_READ, retry)
 
 
 def set_position(id_, position, duration):
@@ -55,19 +291,56 @@ def set_position(id_, position, duration):
     :param id_: 要驱动的舵机id
     :param position: 位置
     :param duration: 转动需要的时间
+    启用 move_queue 时只放入合并发送队列
     """
+    if move_queue.running:
+        move_queue.put(((id_, position, duration),))
+        return
     position = set_bounds(position, 0, 1000)
     duration = set_bounds(duration, 0, 30000)
     _ssc.write_cmd(id_, _ssc.MOVE_TIME_WRITE, [position, duration])
+    if config_cache.enabled:
+        config_cache.invalidate(id_, _ssc.LOAD_OR_UNLOAD_READ)  # 转动指令会使舵机上电
+
+
+def _move_cmds(positions):
+    """
+    将多个舵机的目标位置转换为 write_cmds 所需的指令列表
+    :param positions: {id_: (position, duration)} 字典, 或 (id_, position, duration) 的可迭代对象
+    :return: [(id_, MOVE_TIME_WRITE, [position, duration]), ...]
+    """
+    if isinstance(positions, dict):
+        positions = [(id_, p, d) for id_, (p, d) in positions.items()]
+    cmds = [(id_, _ssc.MOVE_TIME_WRITE, [set_bounds(position, 0, 1000), set_bounds(duration, 0, 30000)])
+            for id_, position, duration in positions]
+    if config_cache.enabled:
+        for id_, _, _ in cmds:
+            config_cache.invalidate(id_, _ssc.LOAD_OR_UNLOAD_READ)
+    return cmds
+
+
+def set_positions(positions):
+    """
+    同时驱动多个串口舵机, 所有舵机的指令在一次总线写入中发出
+
+    :param positions: {id_: (position, duration)} 字典, 或 (id_, position, duration) 的可迭代对象
+    启用 move_queue 时只放入合并发送队列
+    """
+    if move_queue.running:
+        move_queue.put([(id_, p, d) for id_, (p, d) in positions.items()] if isinstance(positions, dict) else positions)
+        return
+    _ssc.write_cmds(_move_cmds(positions))
 
 
 def stop(id_=None):
     """
-    停止舵机运行
-    :param id_:
+    停止舵机运行, move_queue 中该舵机尚未发出的转动指令一并作废
+    :param id_: 舵机id, 默认为广播id, 停止总线上所有舵机
     :return:
     """
-    _ssc.write_cmd(id_, _ssc.MOVE_STOP)
+    id_ = _ssc.BROADCAST_ID if id_ is None else id_
+    with move_queue.preempt(id_):
+        _ssc.write_cmd(id_, _ssc.MOVE_STOP)
 
 
 def set_deviation(id_, d=0):
@@ -76,7 +349,8 @@ def set_deviation(id_, d=0):
     :param id_: 舵机id
     :param d:  偏差
     """
-    _ssc.write_cmd(id_, _ssc.ANGLE_OFFSET_ADJUST, d)
+    _ssc.write_cmd(id_, _ssc.ANGLE_OFFSET_ADJUST, int(d) & 0xFF)  # 偏差为有符号字节
+    config_cache.update(id_, _ssc.ANGLE_OFFSET_READ, (int(d),))
 
 
 def save_deviation(id_):
@@ -94,7 +368,7 @@ def get_deviation(id_, retry=50):
     :param retry: 重试次数
     :return:
     """
-    return _ssc.read_msg(id_, _ssc.ANGLE_OFFSET_READ)
+    return config_cache.read(id_, _ssc.ANGLE_OFFSET_READ, retry)
 
 
 def set_position_limit(id_, low, high):
@@ -106,6 +380,7 @@ def set_position_limit(id_, low, high):
     :return:
     """
     _ssc.write_cmd(id_, _ssc.ANGLE_LIMIT_WRITE, [low, high])
+    config_cache.update(id_, _ssc.ANGLE_LIMIT_READ, (low, high))
 
 
 def get_position_limit(id_, retry=50):
@@ -115,7 +390,7 @@ def get_position_limit(id_, retry=50):
     :param retry:
     :return: 返回元祖 0： 低位  1： 高位
     """
-    return _ssc.read_msg(_ssc.ANGLE_LIMIT_READ, retry)
+    return config_cache.read(id_, _ssc.ANGLE_LIMIT_READ, retry)
 
 
 def set_vin_limit(id_, low, high):
@@ -127,6 +402,7 @@ def set_vin_limit(id_, low, high):
     :return:
     """
     _ssc.write_cmd(id_, _ssc.VIN_LIMIT_WRITE, [low, high])
+    config_cache.update(id_, _ssc.VIN_LIMIT_READ, (low, high))
 
 
 def get_vin_limit(id_, retry=50):
@@ -135,7 +411,7 @@ def get_vin_limit(id_, retry=50):
     :param id_:
     :return: 返回元祖 0： 低位  1： 高位
     """
-    return _ssc.read_msg(id_, _ssc.VIN_LIMIT_READ, retry)
+    return config_cache.read(id_, _ssc.VIN_LIMIT_READ, retry)
 
 
 def set_thermal_limit(id_, m_temp):
@@ -145,7 +421,8 @@ def set_thermal_limit(id_, m_temp):
     :param m_temp:
     :return:
     """
-    _ssc.write_cmd(_ssc.TEMP_MAX_LIMIT_WRITE, m_temp)
+    _ssc.write_cmd(id_, _ssc.TEMP_MAX_LIMIT_WRITE, m_temp)
+    config_cache.update(id_, _ssc.TEMP_MAX_LIMIT_READ, (m_temp,))
 
 
 def get_thermal_limit(id_, retry=50):
@@ -155,7 +432,7 @@ def get_thermal_limit(id_, retry=50):
     :param retry:
     :return:
     """
-    return _ssc.read_msg(id_, _ssc.TEMP_MAX_LIMIT_READ, retry)
+    return config_cache.read(id_, _ssc.TEMP_MAX_LIMIT_READ, retry)
 
 
 def get_position(id_, retry=50):
@@ -196,16 +473,18 @@ def reset_all(id_):
     """
     set_deviation(id_, 0)  # 清零偏差
     time.sleep(0.1)
-    _ssc.write_cmd(id_, _ssc.MOVE_TIME_WRITE, [500, 1000])  # 中位
+    set_position(id_, 500, 1000)  # 中位
 
 
 def unload(id_):
     """
-    舵机掉电
+    舵机掉电, move_queue 中该舵机尚未发出的转动指令一并作废
     :param id_:
     :return:
     """
-    _ssc.write_cmd(id_, _ssc.LOAD_OR_UNLOAD_WRITE, 0)
+    with move_queue.preempt(id_):
+        _ssc.write_cmd(id_, _ssc.LOAD_OR_UNLOAD_WRITE, 0)
+    config_cache.update(id_, _ssc.LOAD_OR_UNLOAD_READ, (0,))
 
 
 def get_load_state(id_, retry=50):
@@ -215,4 +494,4 @@ def get_load_state(id_, retry=50):
     :param retry:
     :return:
     """
-    return _ssc.read_msg(id_, _ssc.LOAD_OR_UNLOAD_READ, retry)
+    return config_cache.read(id_, _ssc.LOAD_OR_UNLOAD_READ, retry)
@@ -0,0 +1,295 @@
+# This file is part of rsp_robot_hat_v3.
+# Copyright (C) 2021 Hiwonder Ltd. <support@hiwonder.com>
+#
+# rsp_robot_hat_v3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rsp_robot_hat_v3 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# title           :serial_servo_aio.py
+# author          :Hiwonder, LuYongping(Lucas)
+# date            :20261018
+# notes           :asyncio version of serial_servo
+# ==============================================================================
+
+import time
+import asyncio
+import weakref
+import contextlib
+from . import _serial_servo_commands as _ssc
+from . import serial_servo as _serial_servo
+
+_LOCK_POLL = 0.0005  # 总线被同步接口占用时的轮询间隔(秒)
+_loop_locks = weakref.WeakKeyDictionary()
+
+
+def _loop_lock(loop):
+    # 同一事件循环中的协程先在 asyncio.Lock 上排队
+    loop_lock = _loop_locks.get(loop)
+    if loop_lock is None:
+        loop_lock = _loop_locks[loop] = asyncio.Lock()
+    return loop_lock
+
+
+@contextlib.asynccontextmanager
+async def _bus():
+    """
+    占用总线
+    排队后以非阻塞方式获取与同步接口共用的 _ssc.lock, 持锁期间不得 await
+    """
+    async with _loop_lock(asyncio.get_running_loop()):
+        while not _ssc.lock.acquire(blocking=False):
+            await asyncio.sleep(_LOCK_POLL)
+        try:
+            yield
+        finally:
+            _ssc.lock.release()
+
+
+async def _bus_call(cmds, ids, func, *args):
+    # 启用了 bus_arbiter 时交由总线线程按优先级执行, 否则在事件循环中直接执行; 与同步接口一样计入 bus_metrics
+    if _ssc._serial_handle is None:
+        _ssc.port_open()
+    start = time.perf_counter()
+    arbiter = _ssc._arbiter
+    if arbiter is not None:
+        result = await asyncio.wrap_future(arbiter.submit(cmds, func, *args))
+        wait = None
+    else:
+        async with _bus():
+            wait = time.perf_counter() - start
+            result = func(*args)
+    _ssc.bus_metrics.record(cmds[0], time.perf_counter() - start, ids, wait)
+    return result
+
+
+async def write_cmd(id_, cmd, params=None):
+    """
+    写指令
+    :param id_:
+    :param cmd:
+    :param params:
+    :return: None
+    """
+    await _bus_call((cmd,), (id_,), _ssc._write_cmd, id_, cmd, params)
+
+
+async def write_cmds(cmds):
+    """
+    批量写指令, 见 _serial_servo_commands.write_cmds
+    :param cmds: (id_, cmd, params) 的列表
+    :return: None
+    """
+    if cmds:
+        await _bus_call([c[1] for c in cmds], [c[0] for c in cmds], _ssc._write_cmds, cmds)
+
+
+async def write_frames(data, cmd=_ssc.MOVE_TIME_WRITE):
+    """
+    写入已编码好的帧, 见 _serial_servo_commands.write_frames
+    :param data: 一帧或连续多帧的 bytes
+    :param cmd: 帧中的指令
+    :return: None
+    """
+    await _bus_call((cmd,), (), _ssc._write_frames, data)
+
+
+def _locked(func, *args):
+    # 在执行器线程中持有 _ssc.lock 调用, 事件循环线程从不在 await 期间持有这把线程锁
+    # :return: (等待 lock 的时间, func 的返回值)
+    t = time.perf_counter()
+    with _ssc.lock:
+        wait = time.perf_counter() - t
+        return wait, func(*args)
+
+
+async def _read_once(id_, cmd, timeout):
+    """
+    一次读取尝试. 发送与等待应答在执行器线程中持锁完成, 期间同一线程中的同步接口只会等到本次尝试结束,
+    不会因为等待事件循环而永远阻塞
+    :return: (应答, 等待 lock 的时间), 经 bus_arbiter 排队时等待时间为 None
+    """
+    if _ssc._serial_handle is None:
+        _ssc.port_open()
+    arbiter = _ssc._arbiter
+    if arbiter is not None:
+        msg = await asyncio.wrap_future(arbiter.submit((cmd,), _ssc._read_once, id_, cmd, timeout, expire_ok=True))
+        return msg, None
+    loop = asyncio.get_running_loop()
+    t = time.perf_counter()
+    async with _loop_lock(loop):
+        queued = time.perf_counter() - t
+        wait, msg = await loop.run_in_executor(None, _locked, _ssc._read_once, id_, cmd, timeout)
+    return msg, queued + wait
+
+
+async def read_msg(id_, cmd, retry=50, timeout=_ssc.REPLY_TIMEOUT):
+    """
+    发送读取命令并等待应答, 每次尝试之间释放总线
+    :param id_:
+    :param cmd: 读取命令
+    :param retry: 最多尝试次数
+    :param timeout: 每次尝试等待应答的最长时间(秒)
+    :return: 数据, 全部失败返回 None
+    """
+    start = time.perf_counter()
+    wait = None  # 各次尝试等待总线的时间之和, 经 bus_arbiter 排队时不统计
+    attempts = 0
+    msg = None
+    for attempts in range(1, retry + 1):
+        msg, attempt_wait = await _read_once(id_, cmd, timeout)
+        if attempt_wait is not None:
+            wait = (wait or 0.0) + attempt_wait
+        if msg is not None:
+            break
+    _ssc.bus_metrics.record(cmd, time.perf_counter() - start, (id_,), wait, max(attempts - 1, 0), msg is None)
+    return msg
+
+
+async def set_position(id_, position, duration):
+    """
+    驱动串口舵机转到指定位置
+    """
+    await write_cmds(_serial_servo._move_cmds(((id_, position, duration),)))
+
+
+async def set_positions(positions):
+    """
+    同时驱动多个串口舵机, 所有舵机的指令在一次总线写入中发出
+
+    :param positions: {id_: (position, duration)} 字典, 或 (id_, position, duration) 的可迭代对象
+    """
+    await write_cmds(_serial_servo._move_cmds(positions))
+
+
+async def stop(id_=None):
+    """
+    停止舵机运行, serial_servo.move_queue 中该舵机尚未发出的转动指令一并作废
+    :param id_: 舵机id, 默认为广播id, 停止总线上所有舵机
+    """
+    id_ = _ssc.BROADCAST_ID if id_ is None else id_
+    _serial_servo.move_queue.cancel(id_)
+    await write_cmd(id_, _ssc.MOVE_STOP)
+
+
+async def unload(id_):
+    """
+    舵机掉电, serial_servo.move_queue 中该舵机尚未发出的转动指令一并作废
+    """
+    _serial_servo.move_queue.cancel(id_)
+    await write_cmd(id_, _ssc.LOAD_OR_UNLOAD_WRITE, 0)
+    _serial_servo.config_cache.update(id_, _ssc.LOAD_OR_UNLOAD_READ, (0,))
+
+
+async def _read_config(id_, cmd, retry):
+    # 与同步接口共用 serial_servo.config_cache, 缓存命中时不访问总线
+    cache = _serial_servo.config_cache
+    value = cache._lookup(id_, cmd)
+    if value is None:
+        value = await read_msg(id_, cmd, retry)
+        cache._store(id_, cmd, value)
+    return value
+
+
+async def set_id(new_id, old_id=_ssc.BROADCAST_ID):
+    """
+    设置舵机id, 见 serial_servo.set_id
+    """
+    await write_cmd(old_id, _ssc.ID_WRITE, new_id)
+    cache = _serial_servo.config_cache
+    cache.invalidate(old_id)
+    cache.invalidate(new_id)
+    cache.invalidate(_ssc.BROADCAST_ID, _ssc.ID_READ)
+
+
+async def set_deviation(id_, d=0):
+    """
+    调整偏差
+    """
+    await write_cmd(id_, _ssc.ANGLE_OFFSET_ADJUST, int(d) & 0xFF)  # 偏差为有符号字节
+    _serial_servo.config_cache.update(id_, _ssc.ANGLE_OFFSET_READ, (int(d),))
+
+
+async def save_deviation(id_):
+    """
+    配置偏差，掉电保护
+    """
+    await write_cmd(id_, _ssc.ANGLE_OFFSET_WRITE)
+
+
+async def set_position_limit(id_, low, high):
+    """
+    设置舵机转动范围
+    """
+    await write_cmd(id_, _ssc.ANGLE_LIMIT_WRITE, [low, high])
+    _serial_servo.config_cache.update(id_, _ssc.ANGLE_LIMIT_READ, (low, high))
+
+
+async def set_vin_limit(id_, low, high):
+    """
+    设置舵机电压范围
+    """
+    await write_cmd(id_, _ssc.VIN_LIMIT_WRITE, [low, high])
+    _serial_servo.config_cache.update(id_, _ssc.VIN_LIMIT_READ, (low, high))
+
+
+async def set_thermal_limit(id_, m_temp):
+    """
+    设置舵机最高温度报警
+    """
+    await write_cmd(id_, _ssc.TEMP_MAX_LIMIT_WRITE, m_temp)
+    _serial_servo.config_cache.update(id_, _ssc.TEMP_MAX_LIMIT_READ, (m_temp,))
+
+
+async def reset_all(id_):
+    """
+    舵机清零偏差并回到中位(500)
+    """
+    await set_deviation(id_, 0)
+    await asyncio.sleep(0.1)
+    await set_position(id_, 500, 1000)
+
+
+async def get_id(id_=None, retry=50):
+    id_ = id_ if id_ else _ssc.BROADCAST_ID
+    return await _read_config(id_, _ssc.ID_READ, retry)
+
+
+async def get_deviation(id_, retry=50):
+    return await _read_config(id_, _ssc.ANGLE_OFFSET_READ, retry)
+
+
+async def get_position_limit(id_, retry=50):
+    return await _read_config(id_, _ssc.ANGLE_LIMIT_READ, retry)
+
+
+async def get_vin_limit(id_, retry=50):
+    return await _read_config(id_, _ssc.VIN_LIMIT_READ, retry)
+
+
+async def get_thermal_limit(id_, retry=50):
+    return await _read_config(id_, _ssc.TEMP_MAX_LIMIT_READ, retry)
+
+
+async def get_position(id_, retry=50):
+    return await read_msg(id_, _ssc.POS_READ, retry)
+
+
+async def get_temperature(id_, retry=50):
+    return await read_msg(id_, _ssc.TEMP_READ, retry)
+
+
+async def get_vin(id_, retry=50):
+    return await read_msg(id_, _ssc.VIN_READ, retry)
+
+
+async def get_load_state(id_, retry=50):
+    return await _read_config(id_, _ssc.LOAD_OR_UNLOAD_READ, retry)
@@ -0,0 +1,249 @@
+# This file is part of rsp_robot_hat_v3.
+# Copyright (C) 2021 Hiwonder Ltd. <support@hiwonder.com>
+#
+# rsp_robot_hat_v3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rsp_robot_hat_v3 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# title           :servo_emulator.py
+# author          :Hiwonder, LuYongping(Lucas)
+# date            :20261018
+# notes           :virtual serial servo bus on a pty, linux only
+# ==============================================================================
+
+import os
+import pty
+import tty
+import time
+import random
+import select
+import threading
+from . import _serial_servo_commands as _ssc
+from ._serial_servo_frame import FRAME_HEADER, pop_frame
+
+
+class VirtualServo:
+    """
+    一个虚拟串口舵机的寄存器状态
+    """
+
+    def __init__(self, id_, position=500, vin=7400, temperature=35):
+        self.id = id_
+        self.deviation = 0
+        self.position_limit = (0, 1000)
+        self.vin_limit = (4500, 12000)
+        self.thermal_limit = 85
+        self.vin = vin
+        self.temperature = temperature
+        self.load_state = 1
+        self.motor_mode = (0, 0)
+        self.led_ctrl = 0
+        self.led_error = 0
+        self.move_time = (position, 0)
+        self.pending_move = None
+        self._from = position
+        self._to = position
+        self._start = 0.0
+        self._duration = 0.0
+
+    def position(self, now=None):
+        """
+        线性插值得到的当前位置
+        """
+        now = time.monotonic() if now is None else now
+        if self._duration <= 0 or now >= self._start + self._duration:
+            return self._to
+        return int(self._from + (self._to - self._from) * (now - self._start) / self._duration)
+
+    def move(self, position, duration):
+        now = time.monotonic()
+        low, high = self.position_limit
+        self._from = self.position(now)
+        self._to = min(max(position, low), high)
+        self._start = now
+        self._duration = duration / 1000.0
+        self.move_time = (position, duration)
+        self.load_state = 1
+
+    def stop(self):
+        self._to = self._from = self.position()
+        self._duration = 0.0
+
+    def handle(self, cmd, params):
+        """
+        执行一条指令
+        :param cmd:
+        :param params: 参数字节
+        :return: 读指令返回应答数据的元组, 否则返回 None
+        """
+        words = [params[i] | params[i + 1] << 8 for i in range(0, len(params) - 1, 2)]
+        if cmd == _ssc.MOVE_TIME_WRITE and len(words) == 2:
+            self.move(*words)
+        elif cmd == _ssc.MOVE_TIME_WAIT_WRITE and len(words) == 2:
+            self.pending_move = tuple(words)
+        elif cmd == _ssc.MOVE_START and self.pending_move is not None:
+            self.move(*self.pending_move)
+            self.pending_move = None
+        elif cmd == _ssc.MOVE_STOP:
+            self.stop()
+        elif cmd == _ssc.ID_WRITE and params:
+            self.id = params[0]
+        elif cmd == _ssc.ANGLE_OFFSET_ADJUST and params:
+            self.deviation = params[0] - 256 if params[0] > 127 else params[0]
+        elif cmd == _ssc.ANGLE_LIMIT_WRITE and len(words) == 2:
+            self.position_limit = tuple(words)
+        elif cmd == _ssc.VIN_LIMIT_WRITE and len(words) == 2:
+            self.vin_limit = tuple(words)
+        elif cmd == _ssc.TEMP_MAX_LIMIT_WRITE and params:
+            self.thermal_limit = params[0]
+        elif cmd == _ssc.OR_MOTOR_MODE_WRITE and len(words) == 2:
+            self.motor_mode = (words[0] & 0xFF, words[1] - 65536 if words[1] > 32767 else words[1])
+        elif cmd == _ssc.LOAD_OR_UNLOAD_WRITE and params:
+            self.load_state = params[0]
+        elif cmd == _ssc.LED_CTRL_WRITE and params:
+            self.led_ctrl = params[0]
+        elif cmd == _ssc.LED_ERROR_WRITE and params:
+            self.led_error = params[0]
+        elif cmd == _ssc.MOVE_TIME_READ or cmd == _ssc.MOVE_TIME_WAIT_READ:
+            return self.move_time if cmd == _ssc.MOVE_TIME_READ else (self.pending_move or (0, 0))
+        elif cmd == _ssc.ID_READ:
+            return self.id,
+        elif cmd == _ssc.ANGLE_OFFSET_READ:
+            return self.deviation,
+        elif cmd == _ssc.ANGLE_LIMIT_READ:
+            return self.position_limit
+        elif cmd == _ssc.VIN_LIMIT_READ:
+            return self.vin_limit
+        elif cmd == _ssc.TEMP_MAX_LIMIT_READ:
+            return self.thermal_limit,
+        elif cmd == _ssc.TEMP_READ:
+            return self.temperature,
+        elif cmd == _ssc.VIN_READ:
+            return self.vin,
+        elif cmd == _ssc.POS_READ:
+            return self.position(),
+        elif cmd == _ssc.OR_MOTOR_MODE_READ:
+            return self.motor_mode
+        elif cmd == _ssc.LOAD_OR_UNLOAD_READ:
+            return self.load_state,
+        elif cmd == _ssc.LED_CTRL_READ:
+            return self.led_ctrl,
+        elif cmd == _ssc.LED_ERROR_READ:
+            return self.led_error,
+        return None
+
+
+class VirtualServoBus:
+    """
+    基于 pty 的虚拟串口舵机总线
+
+    总线上挂着若干 VirtualServo, 解析主机发来的指令帧并按协议应答, 可以配置应答延时、抖动以及丢帧和错帧的概率.
+    应答按波特率计入传输时间, 用于在没有硬件的环境中测量和回归测试总线性能.
+
+        bus = VirtualServoBus(range(1, 17), delay=0.001)
+        bus.attach()  # 将 _serial_servo_commands 切换到虚拟总线
+    """
+
+    def __init__(self, ids=(1,), delay=0.0008, jitter=0.0002, drop_rate=0.0, corrupt_rate=0.0,
+                 baudrate=115200, seed=None):
+        """
+        :param ids: 虚拟舵机id
+        :param delay: 收到读指令到开始应答的延时(秒)
+        :param jitter: 延时上叠加的 0~jitter 秒均匀随机抖动
+        :param drop_rate: 不应答的概率
+        :param corrupt_rate: 应答帧中翻转一个字节的概率
+        :param baudrate: 用于计算应答的传输时间
+        :param seed: 随机数种子
+        """
+        self.servos = {id_: VirtualServo(id_) for id_ in ids}
+        self.delay = delay
+        self.jitter = jitter
+        self.drop_rate = drop_rate
+        self.corrupt_rate = corrupt_rate
+        self.byte_time = 10.0 / baudrate
+        self.frames = 0
+        self.requests = 0
+        self.replies = 0
+        self.dropped = 0
+        self.corrupted = 0
+        self._random = random.Random(seed)
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._stop_r, self._stop_w = os.pipe()
+        self._thread = threading.Thread(target=self._bus_task, daemon=True)
+        self._thread.start()
+
+    def attach(self):
+        """
+        打开虚拟总线的串口并交给 _serial_servo_commands 使用
+        :return: serial.Serial
+        """
+        import serial
+        handle = serial.Serial(self.port, 115200)
+        _ssc.use_port(handle, direction_control=False)
+        return handle
+
+    def close(self):
+        os.write(self._stop_w, b'\0')
+        self._thread.join()
+        for fd in (self._master, self._slave, self._stop_r, self._stop_w):
+            os.close(fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _reply(self, id_, cmd, values):
+        params = _ssc._reply_structs[cmd].pack(*values)
+        frame = bytearray((FRAME_HEADER, FRAME_HEADER, id_, len(params) + 3, cmd))
+        frame += params
+        frame.append(~sum(frame[2:]) & 0xFF)
+        if self._random.random() < self.corrupt_rate:
+            frame[self._random.randrange(2, len(frame))] ^= 0xFF
+            self.corrupted += 1
+        time.sleep(self.delay + self._random.uniform(0, self.jitter) + len(frame) * self.byte_time)
+        os.write(self._master, bytes(frame))
+        self.replies += 1
+
+    def _bus_task(self):
+        recv_data = bytearray()
+        while True:
+            readable = select.select([self._master, self._stop_r], [], [])[0]
+            if self._stop_r in readable:
+                break
+            recv_data += os.read(self._master, 1024)
+            frame = pop_frame(recv_data)
+            while frame is not None:
+                id_, cmd, params = frame
+                self.frames += 1
+                is_read = cmd in _ssc._reply_structs
+                if id_ == _ssc.BROADCAST_ID:
+                    targets = list(self.servos.values())
+                else:
+                    targets = [s for s in self.servos.values() if s.id == id_]
+                for servo in targets:
+                    values = servo.handle(cmd, params)
+                    if is_read:
+                        self.requests += 1
+                        if self._random.random() < self.drop_rate:
+                            self.dropped += 1
+                        else:
+                            self._reply(servo.id, cmd, values)
+                        break  # 一条读指令只应答一次
+                frame = pop_frame(recv_data)
+
+    def stats(self):
+        return dict(frames=self.frames, requests=self.requests, replies=self.replies,
+                    dropped=self.dropped, corrupted=self.corrupted)
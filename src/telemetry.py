@@ -0,0 +1,149 @@
+# This file is part of rsp_robot_hat_v3.
+# Copyright (C) 2021 Hiwonder Ltd. <support@hiwonder.com>
+#
+# rsp_robot_hat_v3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rsp_robot_hat_v3 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# title           :telemetry.py
+# author          :Hiwonder, LuYongping(Lucas)
+# date            :20261018
+# notes           :
+# ==============================================================================
+
+import time
+import heapq
+import threading
+from . import _serial_servo_commands as _ssc
+
+# 可轮询的寄存器及对应的读指令
+REGISTERS = dict(position=_ssc.POS_READ,
+                 vin=_ssc.VIN_READ,
+                 temperature=_ssc.TEMP_READ,
+                 load_state=_ssc.LOAD_OR_UNLOAD_READ,
+                 deviation=_ssc.ANGLE_OFFSET_READ)
+
+
+class TelemetryPoller:
+    """
+    串口舵机状态轮询器
+
+    由一个后台线程按各寄存器自己的频率轮流读取所有舵机, 最新值连同读取时的 time.monotonic() 时间戳
+    缓存在每个舵机一个的定长列表中, 其它线程通过 latest() 无阻塞地读取, 不再各自占用总线.
+    """
+
+    def __init__(self, ids, rates=None, retry=1, timeout=_ssc.REPLY_TIMEOUT):
+        """
+        :param ids: 要轮询的舵机id
+        :param rates: {寄存器名: 频率(Hz)}, 寄存器名见 REGISTERS, 默认 position 50Hz, vin/temperature 1Hz
+        :param retry: 每次读取的尝试次数
+        :param timeout: 每次尝试等待应答的最长时间(秒)
+        """
+        rates = rates if rates else dict(position=50, vin=1, temperature=1)
+        for name, rate in rates.items():
+            if name not in REGISTERS:
+                raise ValueError("unknown register %r" % name)
+            if rate <= 0:
+                raise ValueError("rate of %r must be greater than 0" % name)
+        self.ids = tuple(ids)
+        self.rates = dict(rates)
+        self.retry = retry
+        self.timeout = timeout
+        self.reads = 0
+        self.failures = 0
+        self.callback_errors = 0  # 回调抛出异常的次数, 异常不会使轮询线程退出
+        self.last_error = None  # 最近一次回调抛出的异常
+        self._slots = {name: i for i, name in enumerate(self.rates)}
+        self._cache = {id_: [None] * len(self._slots) for id_ in self.ids}  # 每个槽位为 (值, 时间戳)
+        self._callbacks = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._poll_task, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def on_change(self, callback):
+        """
+        注册值变化回调, 在轮询线程中以 callback(id_, register, value, timestamp) 调用,
+        回调抛出的异常计入 callback_errors 与 last_error, 不影响其它回调和轮询
+        :param callback:
+        :return: callback
+        """
+        self._callbacks.append(callback)
+        return callback
+
+    def latest(self, id_, register=None):
+        """
+        读取缓存的最新值, 不访问总线
+        :param id_: 舵机id
+        :param register: 寄存器名, 为空时返回该舵机所有寄存器
+        :return: (值, 时间戳), 未读到过时为 None; register 为空时为 {寄存器名: (值, 时间戳)}
+        """
+        slots = self._cache[id_]
+        if register is not None:
+            return slots[self._slots[register]]
+        return {name: slots[i] for name, i in self._slots.items()}
+
+    def _schedule(self):
+        # 每个 (舵机, 寄存器) 一个任务, 同一寄存器的各舵机在一个周期内错开, 避免同时到期
+        now = time.monotonic()
+        tasks = []
+        for name, rate in self.rates.items():
+            period = 1.0 / rate
+            for i, id_ in enumerate(self.ids):
+                tasks.append((now + period * i / len(self.ids), len(tasks), id_, name, period))
+        heapq.heapify(tasks)
+        return tasks
+
+    def _poll_task(self):
+        tasks = self._schedule()
+        while tasks and not self._stop.is_set():
+            due, seq, id_, name, period = tasks[0]
+            delay = due - time.monotonic()
+            if delay > 0 and self._stop.wait(delay):
+                break
+            value = _ssc.read_msg(id_, REGISTERS[name], self.retry, self.timeout)
+            now = time.monotonic()
+            self.reads += 1
+            # 落后时从当前时刻重新排期, 不补发错过的读取
+            heapq.heapreplace(tasks, (max(due + period, now), seq, id_, name, period))
+            if value is None:
+                self.failures += 1
+                continue
+            slots = self._cache[id_]
+            slot = self._slots[name]
+            old = slots[slot]
+            slots[slot] = (value, now)
+            if old is None or old[0] != value:
+                for callback in self._callbacks:
+                    try:
+                        callback(id_, name, value, now)
+                    except Exception as e:
+                        self.callback_errors += 1
+                        self.last_error = e
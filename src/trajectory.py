@@ -0,0 +1,149 @@
+# This file is part of rsp_robot_hat_v3.
+# Copyright (C) 2021 Hiwonder Ltd. <support@hiwonder.com>
+#
+# rsp_robot_hat_v3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rsp_robot_hat_v3 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# title           :trajectory.py
+# author          :Hiwonder, LuYongping(Lucas)
+# date            :20261018
+# notes           :numpy is optional
+# ==============================================================================
+
+import math
+import functools
+from array import array
+from .pid import _numpy  # 第一次生成位移表时才导入 numpy
+
+LINEAR = 'linear'
+TRAPEZOIDAL = 'trapezoidal'
+S_CURVE = 's_curve'
+MIN_JERK = 'min_jerk'
+
+_RAMP = 1.0 / 3  # 梯形速度曲线加速段、减速段各占总时间的比例
+_MIN_RAMP = 0.1  # 限速时梯形加减速段可缩短到的最小比例, 再短则延长转动时间
+
+
+class _ScalarMath:
+    sin = staticmethod(math.sin)
+
+    @staticmethod
+    def where(cond, a, b):
+        return a if cond else b
+
+
+# 归一化曲线 s(t), t 与 s 均在 0~1 之间; m 为 numpy 或 _ScalarMath, 同一份公式既可逐点计算也可向量化计算
+def _linear(t, m):
+    return t
+
+
+def _trapezoidal(t, m, ramp=_RAMP):
+    # 匀加速 - 匀速 - 匀减速, 速度峰值为 1 / (1 - ramp), 默认为平均速度的 1.5 倍
+    v = 1.0 / (1.0 - ramp)
+    k = v / (2 * ramp)
+    return m.where(t < ramp, k * t * t, m.where(t > 1 - ramp, 1 - k * (1 - t) * (1 - t), v * (t - ramp / 2)))
+
+
+def _s_curve(t, m):
+    # 摆线曲线, 起止时速度与加速度均为 0, 加加速度有界
+    return t - m.sin(2 * math.pi * t) / (2 * math.pi)
+
+
+def _min_jerk(t, m):
+    # 最小加加速度曲线 10t^3 - 15t^4 + 6t^5
+    return t * t * t * (10 + t * (-15 + 6 * t))
+
+
+_SHAPES = {LINEAR: _linear, TRAPEZOIDAL: _trapezoidal, S_CURVE: _s_curve, MIN_JERK: _min_jerk}
+PROFILES = tuple(_SHAPES)
+_PEAKS = {LINEAR: 1.0, TRAPEZOIDAL: 1.0 / (1.0 - _RAMP), S_CURVE: 2.0, MIN_JERK: 1.875}  # 速度峰值 / 平均速度
+
+
+def _plan(delta, duration, kind, v_max):
+    """
+    :return: (转动时间, 梯形加减速段比例), 使速度峰值不超过 v_max
+    """
+    if v_max is None or delta == 0:
+        return duration, _RAMP
+    if v_max <= 0:
+        raise ValueError("v_max must be greater than 0")
+    distance = abs(delta) * 1000.0  # 位移 * 毫秒/秒, 除以毫秒数即为每秒速度
+    if kind == TRAPEZOIDAL:
+        # 先缩短加减速段、降低匀速段速度, 保持转动时间; 加减速段短于 _MIN_RAMP 时再延长时间
+        ramp = 1.0 - distance / duration / v_max if duration > 0 else 0.0
+        if ramp >= _RAMP:
+            return duration, _RAMP
+        if ramp >= _MIN_RAMP:
+            return duration, ramp
+        return distance / (v_max * (1.0 - _MIN_RAMP)), _MIN_RAMP
+    return max(duration, distance * _PEAKS[kind] / v_max), _RAMP
+
+
+def limit_duration(delta, duration, kind=LINEAR, v_max=None):
+    """
+    :param delta: 总位移
+    :param duration: 要求的转动时间(毫秒)
+    :param kind: 曲线类型, 见 PROFILES
+    :param v_max: 速度上限(每秒位移), 为 None 时不限速
+    :return: 按该曲线转动时速度峰值不超过 v_max 的转动时间(毫秒), 不短于 duration
+    """
+    if kind not in _SHAPES:
+        raise ValueError("unknown profile %r, it must be one of %s" % (kind, ', '.join(PROFILES)))
+    return _plan(delta, duration, kind, v_max)[0]
+
+
+@functools.lru_cache(maxsize=256)
+def profile(delta, duration, kind=LINEAR, rate=50, v_max=None):
+    """
+    生成一段转动的位移表, 结果按参数缓存, 每次更新只需查表
+
+    :param delta: 总位移
+    :param duration: 转动时间(毫秒)
+    :param kind: 曲线类型, 见 PROFILES
+    :param rate: 采样频率(Hz)
+    :param v_max: 速度上限(每秒位移), 为 None 时不限速. 梯形曲线先缩短加减速段、降低匀速段速度,
+                  其它曲线或仍超速时延长转动时间, 实际时间见 limit_duration()
+    :return: 第 i 项为开始后 i / rate 秒时的位移(整数), 最后一项为 delta. 结果被缓存共用, 不要修改
+    """
+    shape = _SHAPES.get(kind)
+    if shape is None:
+        raise ValueError("unknown profile %r, it must be one of %s" % (kind, ', '.join(PROFILES)))
+    duration, ramp = _plan(delta, duration, kind, v_max)
+    if duration <= 0:
+        raise ValueError("duration must be greater than 0")
+    if kind == TRAPEZOIDAL:
+        shape = functools.partial(_trapezoidal, ramp=ramp)
+    n = max(1, int(math.ceil(duration * rate / 1000.0)))
+    step = 1000.0 / rate / duration
+    np = _numpy()
+    if np is not None:
+        t = np.minimum(np.arange(n + 1) * step, 1.0)
+        table = np.rint(shape(t, np) * delta).astype(np.int32)
+        table[-1] = delta
+        table.flags.writeable = False
+        return table
+    table = array('i', (int(round(shape(min(i * step, 1.0), _ScalarMath) * delta)) for i in range(n + 1)))
+    table[-1] = delta
+    return table
+
+
+def sample(table, elapsed, rate):
+    """
+    查表得到经过 elapsed 秒时的位移
+    :param table: profile() 的结果
+    :param elapsed: 经过的时间(秒)
+    :param rate: 生成 table 时的采样频率
+    :return:
+    """
+    i = int(elapsed * rate)
+    return int(table[i]) if i < len(table) else int(table[-1])